@@ -5,8 +5,9 @@ logging.basicConfig(format="%(levelname)s - %(name)s -  %(message)s", level=logg
 logging.getLogger("haystack").setLevel(logging.INFO)
 
 # %%
+import numpy as np
 import pandas as pd
-import os, json
+import os, json, hashlib
 
 from haystack.document_stores import FAISSDocumentStore
 # from haystack.document_stores import ElasticsearchDocumentStore
@@ -43,26 +44,125 @@ def read_json_to_tables(filename):
 
     return processed_tables
 
-def read_csv_to_tables(filename):
-    processed_tables = []
-    with open(filename) as file:
-        current_df = pd.read_csv(file, nrows=10000, index_col=False)
-        print(filename, current_df)
-        document = Document(content=current_df, content_type="table", id=os.path.splitext(os.path.basename(filename))[0])
-        processed_tables.append(document)
-
-    return processed_tables
+def cell_tokens(cells):
+    # About four characters per wordpiece and at least one token per cell, close enough to budget TAPAS inputs
+    if isinstance(cells, pd.DataFrame):
+        lengths = np.column_stack([cells.iloc[:, i].str.len().values for i in range(cells.shape[1])]) if len(cells) else np.zeros(cells.shape, np.int64)
+    else:
+        lengths = pd.Series(cells, dtype=str).str.len().values
+    return lengths // 4 + 1
+
+def column_groups(columns, sample, max_tokens):
+    """Split the columns so the header and one row of each group take at most a quarter of `max_tokens`,
+        a document of a group then holds a few rows at least however wide the table is
+    """
+    widths = cell_tokens(list(columns)) + (cell_tokens(sample).mean(axis=0) if len(sample) else 1)
+    groups, group, width = [], [], 0
+    for column, column_width in zip(columns, widths):
+        if group and width + column_width > max_tokens // 4:
+            groups.append(group)
+            group, width = [], 0
+        group.append(column)
+        width += column_width
+    return groups + [group]
+
+def iter_csv_tables(filename, max_tokens=512, max_rows=None, read_rows=10000, sample_rows=1000):
+    """Stream a CSV file as table documents that fit in `max_tokens` tokens each, header included.
+        pandas reads `read_rows` rows at a time, so memory stays the same whatever the size of the file.
+        Tables too wide for a few rows to fit are split into groups of columns, each chunked on its own.
+
+    Args:
+        filename (str): CSV file
+        max_tokens (int, optional): Estimated tokens per document, header and rows, TAPAS reads 512. Defaults to 512.
+        max_rows (int, optional): Rows read from the file. Defaults to all of them.
+        read_rows (int, optional): Rows pandas reads at once, the memory bound. Defaults to 10000.
+        sample_rows (int, optional): Rows the column widths are estimated on. Defaults to 1000.
+
+    Yields:
+        Document: Table of each chunk, with an id hashed from its file, columns, position and content
+    """
+    source = os.path.splitext(os.path.basename(filename))[0]
+    read = lambda **kwargs: pd.read_csv(filename, index_col=False, dtype=object, keep_default_na=False, **kwargs)
+    sample = read(nrows=sample_rows if max_rows is None else min(sample_rows, max_rows))
+    groups = column_groups(sample.columns, sample, max_tokens)
+    headers = [cell_tokens(group).sum() for group in groups]
+    # Per group: rows of the chunk in progress, carried over to the next read so chunks do not depend on read_rows
+    carry = [sample.iloc[:0][group] for group in groups]
+    chunk_index = [0] * len(groups)
+    first_row = [0] * len(groups)
+
+    def chunks(g, rows, last):
+        group = groups[g]
+        rows = pd.concat([carry[g], rows[group]], ignore_index=True)
+        row_tokens = cell_tokens(rows).sum(axis=1) if len(rows) else []
+        row_hashes = pd.util.hash_pandas_object(rows, index=False).values
+        start, total = 0, headers[g]
+        for i, tokens in enumerate(row_tokens):
+            # A row longer than the budget on its own still gets a document
+            if i > start and total + tokens > max_tokens:
+                yield document(g, rows.iloc[start:i], row_hashes[start:i])
+                start, total = i, headers[g]
+            total += tokens
+        if last and start < len(rows):
+            yield document(g, rows.iloc[start:], row_hashes[start:])
+            start = len(rows)
+        carry[g] = rows.iloc[start:]
+
+    def document(g, chunk, row_hashes):
+        # The source, column group and chunk index keep chunks with the same content apart,
+        # the same rows of the same file still get the same id, so a new run skips what is already in the store
+        key = json.dumps([source, g, chunk_index[g], groups[g]]).encode("utf-8")
+        content_hash = hashlib.sha256(key + row_hashes.tobytes()).hexdigest()
+        meta = {"source": source, "first_row": first_row[g], "rows": len(chunk), "column_group": g, "chunk": chunk_index[g]}
+        chunk_index[g] += 1
+        first_row[g] += len(chunk)
+        return Document(content=chunk.reset_index(drop=True), content_type="table", id=content_hash[:32], meta=meta)
+
+    for rows in read(chunksize=read_rows, nrows=max_rows):
+        for g in range(len(groups)):
+            yield from chunks(g, rows, last=False)
+    for g in range(len(groups)):
+        yield from chunks(g, sample.iloc[:0], last=True)
+
+def read_csv_to_tables(filename, **kwargs):
+    return list(iter_csv_tables(filename, **kwargs))
+
+def write_csv_tables(filename, document_store, index=document_index, batch_size=256, **kwargs):
+    """Write the table documents of a CSV file to the store `batch_size` documents at a time
+
+    Args:
+        filename (str): CSV file
+        document_store (BaseDocumentStore): Store to write to
+        index (str, optional): Index of the store. Defaults to document_index.
+        batch_size (int, optional): Documents per write. Defaults to 256.
+        **kwargs: Arguments of iter_csv_tables
+
+    Returns:
+        list: Ids of the documents, in the order of the rows
+    """
+    ids, batch = [], []
+    for document in iter_csv_tables(filename, **kwargs):
+        batch.append(document)
+        if len(batch) == batch_size:
+            document_store.write_documents(batch, index=index, duplicate_documents="skip")
+            ids += [document.id for document in batch]
+            batch = []
+    if batch:
+        document_store.write_documents(batch, index=index, duplicate_documents="skip")
+        ids += [document.id for document in batch]
+    print(filename, "{} table documents".format(len(ids)))
+    return ids
 
 # tables = read_json_to_tables(f"{doc_dir}/tables.json")
 # https://insights.stackoverflow.com/survey
-tables = read_csv_to_tables("data/survey/survey_results_schema.csv")
-tables = read_csv_to_tables("data/survey/survey_results_public.csv")
-document_store.write_documents(tables, index=document_index)
+schema_ids = write_csv_tables("data/survey/survey_results_schema.csv", document_store)
+survey_ids = write_csv_tables("data/survey/survey_results_public.csv", document_store)
 
 # Showing content field and meta field of one of the Documents of content_type 'table'
-print(tables[0].content)
+table = document_store.get_document_by_id(survey_ids[0], index=document_index)
+print(table.content)
 print("="*50)
-print(tables[0].meta)
+print(table.meta)
 
 # %%
 retriever = EmbeddingRetriever(document_store=document_store, embedding_model="deepset/all-mpnet-base-v2-table")
@@ -74,7 +174,7 @@ print(retrieved_tables[0].content)
 
 # %%
 reader = TableReader(model_name_or_path="google/tapas-base-finetuned-wtq", max_seq_len=512)
-table_doc = document_store.get_document_by_id("datasurveysurvey_results_schema.csv")
+table_doc = document_store.get_document_by_id(schema_ids[0], index=document_index)
 # table_doc = document_store.get_document_by_id("36964e90-3735-4ba1-8e6a-bec236e88bb2")
 print(table_doc.content)
 
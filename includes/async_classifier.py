@@ -0,0 +1,261 @@
+import os, json, time, random, asyncio
+
+import openai
+
+from includes.token_budget import get_budget
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+class RateLimiter():
+    """Requests-per-minute and tokens-per-minute limiter, two token buckets refilled continuously.
+        Requests reserve their estimated tokens up front and hand back what they did not use.
+    """
+
+    def __init__(self, rpm=3500, tpm=90000):
+        """
+        Args:
+            rpm (int, optional): Requests per minute. Defaults to 3500.
+            tpm (int, optional): Tokens per minute, prompt and completion. Defaults to 90000.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        """Wait until one request of `tokens` tokens fits in both limits
+
+        Args:
+            tokens (int): Estimated tokens of the request
+        """
+        tokens = min(tokens, self.tpm)
+        # Waiters are served in order so a large request is not starved by small ones
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm)
+                await asyncio.sleep(max(wait, 0.01))
+
+    def release(self, tokens):
+        """Give back reserved tokens the request did not use (negative to charge more)"""
+        self._refill()
+        self.tokens = min(self.tpm, self.tokens + tokens)
+
+class AsyncClassifier():
+    """Classifies texts with concurrent ChatCompletion function calls.
+        Calls are limited by concurrency and an RPM/TPM limiter fed with tiktoken pre-counts,
+        retried with jittered exponential backoff, and each result is appended to a JSONL file as soon as it is done,
+        so an interrupted run resumes with the rows left.
+    """
+
+    def __init__(self, model, system_prompt, functions=None, function_call=None, save_prompt=None, max_tokens=1000, completion_tokens=200,
+                 concurrency=16, rpm=3500, tpm=90000, max_retries=6, timeout=60, api_base=None, api_key=None, ledger=None):
+        """
+        Args:
+            model (str): Chat model, e.g. "gpt-3.5-turbo-0613"
+            system_prompt (str): System prompt of every row
+            functions (list, optional): Function definitions. Defaults to None.
+            function_call (dict, optional): Function the model has to call. Defaults to None.
+            save_prompt (str, optional): Follow-up prompt for a second call with the functions, the first call then runs without them. Defaults to None.
+            max_tokens (int, optional): Token limit of each text. Defaults to 1000.
+            completion_tokens (int, optional): Tokens reserved per call for the answer. Defaults to 200.
+            concurrency (int, optional): Calls in flight at once. Defaults to 16.
+            rpm (int, optional): Requests per minute of the account. Defaults to 3500.
+            tpm (int, optional): Tokens per minute of the account. Defaults to 90000.
+            max_retries (int, optional): Retries of a failed call. Defaults to 6.
+            timeout (int, optional): Seconds per call. Defaults to 60.
+            api_base (str, optional): API url, e.g. a local stub server "http://localhost:8000/v1". Defaults to openai.api_base.
+            api_key (str, optional): API key. Defaults to openai.api_key.
+            ledger (UsageLedger, optional): Ledger recording every call. Defaults to None.
+        """
+        self.model = model
+        self.system_prompt = system_prompt
+        self.functions = functions
+        self.function_call = function_call
+        self.save_prompt = save_prompt
+        self.max_tokens = max_tokens
+        self.completion_tokens = completion_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.api_base = api_base
+        self.api_key = api_key
+        self.ledger = ledger
+        self.budget = get_budget(model)
+        self.limiter = RateLimiter(rpm, tpm)
+        # Tokens every call spends on the function definitions
+        self.function_tokens = self.budget.count(json.dumps(functions)) if functions else 0
+
+    def estimate_tokens(self, messages, functions=None):
+        # ~4 tokens of framing per message, plus the completion reserved up front
+        prompt = sum(self.budget.count(m.get("content") or "") + 4 for m in messages)
+        return prompt + (self.function_tokens if functions else 0) + self.completion_tokens
+
+    async def create(self, messages, functions=None, function_call=None, row_id=None):
+        """One ChatCompletion call under the rate limiter, retried on transient errors
+
+        Args:
+            messages (list): Chat messages
+            functions (list, optional): Function definitions. Defaults to None.
+            function_call (dict, optional): Function the model has to call. Defaults to None.
+            row_id (int, optional): Row of the call, for the ledger. Defaults to None.
+
+        Returns:
+            tuple: (OpenAIObject response, seconds the successful attempt took)
+        """
+        estimate = self.estimate_tokens(messages, functions)
+        kwargs = dict(model=self.model, messages=messages, temperature=0, max_tokens=self.completion_tokens,
+                      api_base=self.api_base, api_key=self.api_key, request_timeout=self.timeout)
+        if functions:
+            kwargs.update(functions=functions, function_call=function_call or "auto")
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(estimate)
+            start_time = time.time()
+            try:
+                response = await openai.ChatCompletion.acreate(**kwargs)
+            except RETRY_ERRORS as e:
+                if self.ledger is not None:
+                    self.ledger.record(self.model, latency=time.time() - start_time, status=type(e).__name__, row_id=row_id)
+                if attempt == self.max_retries:
+                    raise
+                # Full jitter, at least as long as the server asks for
+                retry_after = float((getattr(e, "headers", None) or {}).get("retry-after", 0) or 0)
+                await asyncio.sleep(max(retry_after, random.uniform(0, min(60, 2 ** attempt))))
+                continue
+            self.limiter.release(estimate - response.usage.total_tokens)
+            return response, time.time() - start_time
+
+    async def classify(self, text, row_id=None):
+        """Classify one text
+
+        Args:
+            text (str): Text to classify
+            row_id (optional): Stable id of the row. Defaults to None.
+
+        Returns:
+            dict: row_id, arguments of the function call (None without one), content, usage and messages
+        """
+        short_text, original_count, limited_count = self.budget.truncate(text, self.max_tokens)
+        messages = [{"role": "system", "content": self.system_prompt}, {"role": "user", "content": short_text}]
+        calls = []
+
+        if self.save_prompt:
+            # Thinking step without the functions, then ask for the function call
+            calls.append(await self.create(messages, row_id=row_id))
+            messages += [calls[-1][0].choices[0].message.to_dict(), {"role": "user", "content": self.save_prompt}]
+
+        calls.append(await self.create(messages, self.functions, self.function_call, row_id=row_id))
+        response = calls[-1][0]
+        message = response.choices[0].message.to_dict()
+        arguments = None
+        if message.get("function_call"):
+            try:
+                arguments = json.loads(message["function_call"]["arguments"])
+            except ValueError:
+                arguments = None
+
+        usage = [r.usage.to_dict() for r, _ in calls]
+        if self.ledger is not None:
+            # Labelled with the first value of the function arguments, e.g. the top category
+            first = next(iter(arguments.values()), None) if isinstance(arguments, dict) else None
+            label = first[0] if isinstance(first, list) and first else first
+            for r, latency in calls:
+                self.ledger.record_response(r, latency, row_id=row_id, label=label)
+
+        return {
+            "row_id": row_id,
+            "arguments": arguments,
+            "content": message.get("content"),
+            "tokens": {"original": original_count, "limited": limited_count},
+            "usage": {key: sum(u.get(key, 0) for u in usage) for key in ("prompt_tokens", "completion_tokens", "total_tokens")},
+            "messages": messages + [message],
+        }
+
+    async def run(self, texts, row_ids=None, out_file=None):
+        """Classify texts concurrently, in a notebook: `results = await classifier.run(df[TEXT_COLUMN], df.index)`
+
+        Args:
+            texts (iterable): Texts to classify, e.g. a DataFrame column
+            row_ids (iterable, optional): Stable id of each text, e.g. the DataFrame index. Defaults to the position.
+            out_file (str, optional): JSONL file results are appended to as they finish, rows already in it are not sent again. Defaults to None.
+
+        Returns:
+            list: Result of each text (see classify) in the original order, failed rows hold an "error"
+        """
+        import aiohttp
+
+        texts = [str(text) for text in texts]
+        row_ids = list(row_ids) if row_ids is not None else list(range(len(texts)))
+        self.budget.encode_batch(texts, self.max_tokens)
+
+        done = load_results(out_file) if out_file else {}
+        results = [done.get(str(row_id)) for row_id in row_ids]
+        todo = [i for i, result in enumerate(results) if result is None]
+        print("Rows to classify: {} ({} already in {})".format(len(todo), len(texts) - len(todo), out_file))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        out = open(out_file, "a", encoding="utf-8") if out_file else None
+        start_time = time.time()
+
+        async def run_row(i):
+            async with semaphore:
+                try:
+                    results[i] = await self.classify(texts[i], row_ids[i])
+                except Exception as e:
+                    results[i] = {"row_id": row_ids[i], "error": "{}: {}".format(type(e).__name__, e)}
+                    return
+            if out:
+                out.write(json.dumps(results[i], ensure_ascii=False, default=str) + "\n")
+                out.flush()
+
+        # One pooled connection set for every call of the run
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency))
+        token = openai.aiosession.set(session)
+        try:
+            await asyncio.gather(*(run_row(i) for i in todo))
+        finally:
+            openai.aiosession.reset(token)
+            await session.close()
+            if out:
+                out.close()
+
+        duration = time.time() - start_time
+        print("Classified {} rows in {:.1f}s ({:.2f} rows/s)".format(len(todo), duration, len(todo) / duration if duration else 0))
+        return results
+
+def load_results(path):
+    """Results already written to a JSONL file, by row id. Failed rows are left out so they are retried."""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # The last line of an interrupted run may be cut short
+                continue
+            if "error" not in result:
+                results[str(result["row_id"])] = result
+    return results
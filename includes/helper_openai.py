@@ -1,11 +1,22 @@
-def print_job_detail(res):
+def print_job_detail(res, ledger=None, latency=0.0, row_id=None, label=None):
+    """Print the model and token usage of a response
+
+    Args:
+        res (OpenAIObject): Completion or ChatCompletion response
+        ledger (UsageLedger, optional): Ledger the call is also recorded in. Defaults to None.
+        latency (float, optional): Seconds the call took, for the ledger. Defaults to 0.0.
+        row_id (int, optional): Row of the call, for the ledger. Defaults to None.
+        label (str, optional): Result label of the row, for the ledger. Defaults to None.
+    """
     print("Model: {}".format(res.model))
     print("Tokens used: Prompt({}) + Completion({}) = {}".format(*res.usage.values()))
+    if ledger is not None:
+        ledger.record_response(res, latency, row_id=row_id, label=label)
 
-def print_chatcompletion_output(res):
-    print_job_detail(res)
+def print_chatcompletion_output(res, **kwargs):
+    print_job_detail(res, **kwargs)
     print(res.choices[0].message.content)
 
-def print_completion_output(res):
-    print_job_detail(res)
+def print_completion_output(res, **kwargs):
+    print_job_detail(res, **kwargs)
     print(res.choices[0].text)
\ No newline at end of file
@@ -0,0 +1,142 @@
+import json, time, asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class Stage():
+    """One step of a pipeline: a function of named values produced by the item or by earlier stages"""
+
+    def __init__(self, name, fn, inputs, concurrency=4, cache=True):
+        """
+        Args:
+            name (str): Name of the value the stage produces
+            fn (callable): Function or coroutine function called with the `inputs` values as positional arguments
+            inputs (list): Names of the item values or earlier stages it needs
+            concurrency (int, optional): Calls of this stage in flight at once. Defaults to 4.
+            cache (bool, optional): Reuse results for identical inputs, across items and runs. Defaults to True.
+        """
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.concurrency = concurrency
+        self.cache = {} if cache else None
+        self.inflight = {}
+        self.latencies = []
+        self.hits = 0
+        self.errors = 0
+
+    def key(self, args):
+        return json.dumps(args, sort_keys=True, default=str)
+
+class Pipeline():
+    """Runs a DAG of stages for many items concurrently.
+        Each item moves to a stage as soon as the stages it depends on are done, so stages of different
+        items overlap; each stage has its own concurrency limit, result cache and latency record.
+    """
+
+    def __init__(self, stages, max_threads=32):
+        """
+        Args:
+            stages (list): Stages, each only depending on item values and stages listed before it
+            max_threads (int, optional): Threads running the blocking stage functions. Defaults to 32.
+        """
+        self.stages = stages
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="pipeline")
+        names = {stage.name for stage in stages}
+        done = set()
+        for stage in stages:
+            for name in stage.inputs:
+                if name in names and name not in done:
+                    raise ValueError("Stage {} needs {}, which is not listed before it".format(stage.name, name))
+            done.add(stage.name)
+
+    async def _call(self, stage, semaphore, args):
+        key = stage.key(args) if stage.cache is not None else None
+        if key is not None and key in stage.cache:
+            stage.hits += 1
+            return stage.cache[key]
+        if key is not None and key in stage.inflight:
+            stage.hits += 1
+            # An identical call still in flight is awaited rather than repeated
+            return await asyncio.shield(stage.inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            stage.inflight[key] = future
+        try:
+            async with semaphore:
+                start_time = time.time()
+                if asyncio.iscoroutinefunction(stage.fn):
+                    result = await stage.fn(*args)
+                else:
+                    result = await asyncio.get_running_loop().run_in_executor(self.executor, stage.fn, *args)
+                stage.latencies.append(time.time() - start_time)
+        except Exception as e:
+            # Failed calls are not cached, a later item retries them
+            stage.errors += 1
+            future.set_exception(e)
+            future.exception() # marks it retrieved, waiters get it through their own await
+            raise
+        finally:
+            stage.inflight.pop(key, None)
+        if key is not None:
+            stage.cache[key] = result
+        future.set_result(result)
+        return result
+
+    async def _run_item(self, item, semaphores):
+        values = dict(item)
+        tasks = {}
+
+        async def run_stage(stage):
+            args = []
+            for name in stage.inputs:
+                args.append(await tasks[name] if name in tasks else values[name])
+            return await self._call(stage, semaphores[stage.name], args)
+
+        for stage in self.stages:
+            tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+
+        result = dict(item)
+        for stage in self.stages:
+            try:
+                result[stage.name] = await tasks[stage.name]
+            except Exception as e:
+                # Later stages that need this one fail with the same error
+                result[stage.name] = None
+                result.setdefault("error", "{}: {}: {}".format(stage.name, type(e).__name__, e))
+        return result
+
+    async def run(self, items):
+        """Run every item through the pipeline, in a notebook: `results = await pipeline.run(items)`
+
+        Args:
+            items (list): Dicts of the initial values of each item, e.g. [{"question": ...}]
+
+        Returns:
+            list: Each item with the value of every stage added, and an "error" if a stage failed
+        """
+        semaphores = {stage.name: asyncio.Semaphore(stage.concurrency) for stage in self.stages}
+        return await asyncio.gather(*(self._run_item(item, semaphores) for item in items))
+
+    def run_sync(self, items):
+        return asyncio.run(self.run(items))
+
+    def report(self):
+        """Per-stage calls, cache hits, errors and latency percentiles in seconds
+
+        Returns:
+            dict: Stats by stage name
+        """
+        report = {}
+        for stage in self.stages:
+            latencies = sorted(stage.latencies)
+            pick = lambda p: round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 3) if latencies else None
+            report[stage.name] = {
+                "calls": len(latencies),
+                "cache_hits": stage.hits,
+                "errors": stage.errors,
+                "p50": pick(50),
+                "p95": pick(95),
+                "max": round(latencies[-1], 3) if latencies else None,
+                "busy_s": round(sum(latencies), 3),
+            }
+        return report
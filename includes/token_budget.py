@@ -0,0 +1,97 @@
+import tiktoken
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4"):
+    """Memoized tiktoken encoder, `encoding_for_model` is only resolved once per model
+
+    Args:
+        model (str, optional): Tokenizer model to use. Defaults to "gpt-4".
+
+    Returns:
+        tiktoken.Encoding: The encoder of the model
+    """
+    return tiktoken.encoding_for_model(model)
+
+class TokenBudget():
+    """Counts and truncates text against a token limit, encoding each text only once.
+        Results of `encode_batch` are kept so later per-row calls to `truncate` are lookups.
+    """
+
+    def __init__(self, model="gpt-4", max_tokens=None, max_entries=200000):
+        """
+        Args:
+            model (str, optional): Tokenizer model to use. Defaults to "gpt-4".
+            max_tokens (int, optional): Default token limit. Defaults to None (no limit).
+            max_entries (int, optional): Number of pre-computed results to keep. Defaults to 200000.
+        """
+        self.model = model
+        self.encoding = get_encoding(model)
+        self.max_tokens = max_tokens
+        self.max_entries = max_entries
+        self.results = {}
+
+    def count(self, text):
+        """Count number of tokens the text has
+
+        Args:
+            text (str): Text to count
+
+        Returns:
+            int: The token count of the text
+        """
+        return len(self.encoding.encode(text))
+
+    def _truncate_tokens(self, text, tokens, max_tokens):
+        if max_tokens is None or len(tokens) <= max_tokens:
+            return text, len(tokens), len(tokens)
+        return self.encoding.decode(tokens[:max_tokens]), len(tokens), max_tokens
+
+    def truncate(self, text, max_tokens=None):
+        """Limits the text to the token limit and counts it with a single encode
+
+        Args:
+            text (str): Text to shrink
+            max_tokens (int, optional): Maximum tokens allowed for text. Defaults to the budget's max_tokens.
+
+        Returns:
+            tuple: (limited text, original token count, limited token count)
+        """
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        result = self.results.get((text, max_tokens))
+        if result is None:
+            result = self._truncate_tokens(text, self.encoding.encode(text), max_tokens)
+        return result
+
+    def encode_batch(self, texts, max_tokens=None, num_threads=8):
+        """Truncate and count a whole column of texts in one multi-threaded pass
+
+        Args:
+            texts (iterable): Texts to shrink, e.g. a DataFrame column
+            max_tokens (int, optional): Maximum tokens allowed per text. Defaults to the budget's max_tokens.
+            num_threads (int, optional): Threads used by tiktoken. Defaults to 8.
+
+        Returns:
+            list: (limited text, original token count, limited token count) for each text
+        """
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        texts = [str(text) for text in texts]
+        results = [self._truncate_tokens(text, tokens, max_tokens)
+                   for text, tokens in zip(texts, self.encoding.encode_batch(texts, num_threads=num_threads))]
+
+        if len(self.results) + len(results) > self.max_entries:
+            self.results = {}
+        self.results.update({(text, max_tokens): result for text, result in zip(texts, results)})
+        return results
+
+@lru_cache(maxsize=None)
+def get_budget(model="gpt-4"):
+    """Shared TokenBudget of a model
+
+    Args:
+        model (str, optional): Tokenizer model to use. Defaults to "gpt-4".
+
+    Returns:
+        TokenBudget: The budget of the model
+    """
+    return TokenBudget(model)
@@ -1,49 +1,250 @@
-import requests, os
+import requests, os, re, abc, time, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from dotenv import load_dotenv
 load_dotenv()
 
-def search_bing(question):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"}
-    
-    query = "+".join(question.split())
-    url = f"https://www.bing.com/search?q={query}"
-    print(url)
-    
-    response = requests.get(url, headers=headers)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    
-    print(soup)
-
-    answer_box = soup.find('div', class_='b_ans')
-    if answer_box:
-        return answer_box.get_text()
-    
-    snippets = soup.find_all('div', class_='b_caption')
-    if snippets:
-        return snippets[0].get_text()
-    
-    return None
+TIMEOUT = (3.05, 10) # connect, read seconds
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
 
-def search_google(query, api_key):
-    params = {
-        "q": query,
-        "api_key": api_key
-    }
+# ===============
+# SESSION AND CACHE
+# ===============
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Shared requests session, connections are pooled and transient errors retried with backoff
+
+    Returns:
+        requests.Session: The session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+            _session = requests.Session()
+            _session.headers["User-Agent"] = USER_AGENT
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query.replace('"', "").strip().lower())
+
+class TTLCache():
+    """Thread-safe cache whose entries expire after `ttl` seconds, the oldest entries are dropped past `max_entries`"""
+
+    def __init__(self, ttl=3600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.entries.pop(key, None)
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                # dicts keep insertion order, the first entries are the oldest
+                for old in list(self.entries)[:max(1, self.max_entries // 10)]:
+                    del self.entries[old]
+            self.entries[key] = (time.time() + self.ttl, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+CACHE = TTLCache()
+
+# ===============
+# BACKENDS
+# ===============
+class SearchBackend(abc.ABC):
+    """A search engine returning the best text snippet for a query. `url` can point to a local stub."""
+
+    name = "backend"
+
+    def __init__(self, url, timeout=TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    @abc.abstractmethod
+    def search(self, query):
+        """
+        Args:
+            query (str): Search query
+
+        Returns:
+            str: Answer snippet, None without a result
+        """
+
+class SerpApiGoogle(SearchBackend):
+    name = "google"
+
+    def __init__(self, api_key=None, url="https://serpapi.com/search", timeout=TIMEOUT):
+        super().__init__(url, timeout)
+        self.api_key = api_key or os.getenv("SERPAPI_API_KEY")
+
+    def search(self, query):
+        response = get_session().get(self.url, params={"q": query, "api_key": self.api_key}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        if data.get("organic_results"):
+            first_result = data["organic_results"][0]
+            if "snippet" in first_result:
+                return first_result["snippet"]
+
+        return None
+
+class BingHtml(SearchBackend):
+    name = "bing"
+
+    def __init__(self, url="https://www.bing.com/search", timeout=TIMEOUT):
+        super().__init__(url, timeout)
 
-    url = "https://serpapi.com/search"
+    def search(self, query):
+        response = get_session().get(self.url, params={"q": query}, timeout=self.timeout)
+        response.raise_for_status()
+        soup = BeautifulSoup(response.text, 'html.parser')
 
-    response = requests.get(url, params=params)
-    data = response.json()
+        answer_box = soup.find('div', class_='b_ans')
+        if answer_box:
+            return answer_box.get_text()
 
-    if "organic_results" in data:
-        first_result = data["organic_results"][0]
-        if "snippet" in first_result:
-            return first_result["snippet"]
+        snippets = soup.find_all('div', class_='b_caption')
+        if snippets:
+            return snippets[0].get_text()
+
+        return None
+
+BACKENDS = {}
+
+def register_backend(backend):
+    """Make a backend available by name, replacing one of the same name (e.g. with a stub in tests)"""
+    BACKENDS[backend.name] = backend
+
+# Registered at import, so a stub registered later only replaces the engine of its name
+register_backend(SerpApiGoogle())
+register_backend(BingHtml())
+
+def get_backends(names=None):
+    return [BACKENDS[name] for name in (names or BACKENDS)]
+
+# ===============
+# SEARCH
+# ===============
+def _try(backend, query):
+    try:
+        return backend.search(query)
+    except (requests.RequestException, ValueError):
+        return None
+
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="search")
+
+def _cache_key(backends, query):
+    # Answers depend on the engines asked, the same query to another set of engines is another entry
+    return (tuple(sorted(backend.name for backend in backends)), normalize_query(query))
+
+def search_parallel(query, backends=None, timeout=15, cache=CACHE):
+    """Query several engines at once and return the first good answer
+
+    Args:
+        query (str): Search query
+        backends (list, optional): Backend names. Defaults to every registered backend.
+        timeout (float, optional): Seconds to wait for an answer. Defaults to 15.
+        cache (TTLCache, optional): Cache of answers by backends and normalized query, None to skip it. Defaults to CACHE.
+
+    Returns:
+        str: The first answer, None if no engine had one
+    """
+    backends = get_backends(backends)
+    key = _cache_key(backends, query)
+    answer = cache.get(key) if cache is not None else None
+    if answer is not None:
+        return answer
+
+    futures = [_executor.submit(_try, backend, query) for backend in backends]
+    answer = None
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            answer = future.result()
+            if answer:
+                break
+    except FuturesTimeout:
+        pass
+    # Engines still running are left to finish in the background
+    for future in futures:
+        future.cancel()
+
+    if answer and cache is not None:
+        cache.put(key, answer)
+    return answer or None
+
+async def asearch(query, backends=None, timeout=15, cache=CACHE):
+    """search_parallel for asyncio code: `answer = await asearch(query)`"""
+    backends = get_backends(backends)
+    key = _cache_key(backends, query)
+    answer = cache.get(key) if cache is not None else None
+    if answer is not None:
+        return answer
+
+    loop = asyncio.get_running_loop()
+    pending = {loop.run_in_executor(_executor, _try, backend, query) for backend in backends}
+    answer = None
+    deadline = loop.time() + timeout
+    while pending and not answer:
+        done, pending = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            break
+        answer = next((task.result() for task in done if task.result()), None)
+    for task in pending:
+        task.cancel()
+
+    if answer and cache is not None:
+        cache.put(key, answer)
+    return answer
+
+async def asearch_many(queries, backends=None, timeout=15, cache=CACHE):
+    """Search several queries concurrently
+
+    Args:
+        queries (list): Search queries
+
+    Returns:
+        list: Answer of each query, None where no engine had one
+    """
+    return await asyncio.gather(*(asearch(query, backends, timeout, cache) for query in queries))
+
+def search_bing(question):
+    return _cached(get_backends(["bing"])[0], question)
+
+def search_google(query, api_key):
+    backend = get_backends(["google"])[0]
+    if api_key and api_key != getattr(backend, "api_key", api_key):
+        backend = SerpApiGoogle(api_key, url=backend.url, timeout=backend.timeout)
+    return _cached(backend, query)
 
-    return None
+def _cached(backend, query, cache=CACHE):
+    key = _cache_key([backend], query)
+    answer = cache.get(key)
+    if answer is None:
+        # An HTTP or parsing error is no answer rather than an exception, as before raise_for_status
+        answer = _try(backend, query)
+        if answer:
+            cache.put(key, answer)
+    return answer
 
 if __name__ == '__main__':
 
@@ -60,4 +261,4 @@ if __name__ == '__main__':
     # Example usage
     question = "Tokyo high temperature yesterday"
     result = tools['search']['execute'](question, os.getenv("SERPAPI_API_KEY"))
-    print(result)
\ No newline at end of file
+    print(result)
@@ -0,0 +1,252 @@
+import os, json, time, shutil, tempfile
+
+import numpy as np
+
+# USD per 1k tokens (prompt, completion), matched on the model name prefix
+PRICES = {
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "text-davinci-003": (0.02, 0.02),
+}
+
+NUMERIC_COLUMNS = {
+    "time": np.float64,
+    "prompt_tokens": np.int32,
+    "completion_tokens": np.int32,
+    "latency": np.float32,
+    "row_id": np.int64, # integer row ids (e.g. a DataFrame index), -1 for none
+}
+# Repeated strings, stored as int32 codes into a shared list of values
+CODED_COLUMNS = ("model", "status", "label")
+
+class UsageLedger():
+    """Per-call usage records (model, tokens, latency, status, row id and label) in fixed-size numpy chunks.
+        Full chunks are spilled to .npz files, so memory stays at one chunk however many calls are recorded;
+        aggregations read the spilled chunks back one column at a time.
+        Without a `spill_dir` the chunks go to a temporary directory, deleted by close() or when the ledger is collected.
+    """
+
+    def __init__(self, spill_dir=None, chunk_size=50000, prices=PRICES):
+        """
+        Args:
+            spill_dir (str, optional): Directory of the spilled chunks. Defaults to a new temporary directory.
+            chunk_size (int, optional): Calls held in memory before a spill. Defaults to 50000.
+            prices (dict, optional): USD per 1k (prompt, completion) tokens by model name prefix. Defaults to PRICES.
+        """
+        # Only a directory made here is deleted with the ledger
+        self.owns_dir = spill_dir is None
+        self.closed = False
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="usage_ledger_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.prices = prices
+        self.values = {column: [] for column in CODED_COLUMNS}
+        self.codes = {column: {} for column in CODED_COLUMNS}
+        self.parts = []
+        self.spilled = 0
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self.size = 0
+        self.chunk = {column: np.zeros(self.chunk_size, dtype) for column, dtype in NUMERIC_COLUMNS.items()}
+        self.chunk.update({column: np.zeros(self.chunk_size, np.int32) for column in CODED_COLUMNS})
+
+    def _code(self, column, value):
+        value = None if value is None else str(value)
+        codes = self.codes[column]
+        if value not in codes:
+            codes[value] = len(self.values[column])
+            self.values[column].append(value)
+        return codes[value]
+
+    def record(self, model, prompt_tokens=0, completion_tokens=0, latency=0.0, status="ok", row_id=None, label=None):
+        """Add one call
+
+        Args:
+            model (str): Model name
+            prompt_tokens (int, optional): Prompt tokens. Defaults to 0.
+            completion_tokens (int, optional): Completion tokens. Defaults to 0.
+            latency (float, optional): Seconds the call took. Defaults to 0.0.
+            status (str, optional): "ok" or an error name. Defaults to "ok".
+            row_id (int, optional): Row the call was made for. Defaults to None.
+            label (str, optional): Result label of the row, e.g. its category. Defaults to None.
+        """
+        if self.closed:
+            raise ValueError("ledger is closed, its spill directory was deleted")
+        i = self.size
+        self.chunk["time"][i] = time.time()
+        self.chunk["prompt_tokens"][i] = prompt_tokens
+        self.chunk["completion_tokens"][i] = completion_tokens
+        self.chunk["latency"][i] = latency
+        self.chunk["row_id"][i] = -1 if row_id is None else int(row_id)
+        for column, value in (("model", model), ("status", status), ("label", label)):
+            self.chunk[column][i] = self._code(column, value)
+        self.size += 1
+        if self.size == self.chunk_size:
+            self.spill()
+
+    def record_response(self, response, latency=0.0, row_id=None, label=None):
+        """Add a call from an OpenAI response"""
+        usage = response["usage"]
+        self.record(response["model"], usage["prompt_tokens"], usage.get("completion_tokens", 0), latency, row_id=row_id, label=label)
+
+    def spill(self):
+        """Write the in-memory chunk to disk and start a new one"""
+        if self.size == 0:
+            return
+        path = os.path.join(self.spill_dir, "part-{:05d}.npz".format(len(self.parts)))
+        np.savez(path, **{column: values[:self.size] for column, values in self.chunk.items()})
+        self.parts.append(path)
+        self.spilled += self.size
+        self._new_chunk()
+
+    def __len__(self):
+        return self.spilled + self.size
+
+    def column(self, name):
+        """One column over every recorded call, coded columns as their codes"""
+        arrays = []
+        for path in self.parts:
+            with np.load(path) as part:
+                arrays.append(part[name])
+        arrays.append(self.chunk[name][:self.size])
+        return np.concatenate(arrays)
+
+    def decoded(self, name):
+        return np.array(self.values[name], dtype=object)[self.column(name)]
+
+    def costs(self):
+        """USD cost of every call, 0 for models without a price"""
+        prices = np.zeros((len(self.values["model"]), 2))
+        for code, model in enumerate(self.values["model"]):
+            for prefix, price in sorted(self.prices.items(), key=lambda item: -len(item[0])):
+                if model and model.startswith(prefix):
+                    prices[code] = price
+                    break
+        model = self.column("model")
+        return (self.column("prompt_tokens") * prices[model, 0] + self.column("completion_tokens") * prices[model, 1]) / 1000
+
+    def group_sum(self, by, values):
+        """Sum `values` per value of a coded column
+
+        Args:
+            by (str): Coded column, "model", "status" or "label"
+            values (np.ndarray): One value per call
+
+        Returns:
+            dict: Sum by value of the column
+        """
+        sums = np.bincount(self.column(by), weights=values, minlength=len(self.values[by]))
+        return {value: float(total) for value, total in zip(self.values[by], sums)}
+
+    def tokens_per_row(self):
+        """Total tokens of each row, over every call made for it"""
+        row_ids, inverse = np.unique(self.column("row_id"), return_inverse=True)
+        totals = np.bincount(inverse, weights=self.column("prompt_tokens").astype(np.int64) + self.column("completion_tokens"))
+        return dict(zip(row_ids.tolist(), totals.astype(np.int64).tolist()))
+
+    def cost_by(self, by="label"):
+        return self.group_sum(by, self.costs())
+
+    def latency_percentiles(self, percentiles=(50, 95, 99), status="ok"):
+        """Latency percentiles in seconds, of the calls with `status` (None for all)"""
+        latency = self.column("latency")
+        if status is not None:
+            # A status never recorded has no calls, not all of them
+            code = self.codes["status"].get(status, -1)
+            latency = latency[self.column("status") == code]
+        if len(latency) == 0:
+            return {p: None for p in percentiles}
+        return {p: float(v) for p, v in zip(percentiles, np.percentile(latency, percentiles))}
+
+    def summary(self):
+        """Calls, tokens, cost and latency of the whole ledger
+
+        Returns:
+            dict: Totals per model, status counts and latency percentiles
+        """
+        calls = self.group_sum("model", np.ones(len(self)))
+        prompt = self.group_sum("model", self.column("prompt_tokens"))
+        completion = self.group_sum("model", self.column("completion_tokens"))
+        cost = self.cost_by("model")
+        return {
+            "calls": len(self),
+            "models": {model: {"calls": int(calls[model]), "prompt_tokens": int(prompt[model]), "completion_tokens": int(completion[model]),
+                               "cost": round(cost[model], 6)} for model in calls},
+            "status": {status: int(n) for status, n in self.group_sum("status", np.ones(len(self))).items()},
+            "latency": self.latency_percentiles(),
+        }
+
+    def to_frame(self):
+        """All calls as a DataFrame, for ad hoc analysis of ledgers that fit in memory"""
+        import pandas as pd
+
+        frame = pd.DataFrame({column: self.column(column) for column in NUMERIC_COLUMNS})
+        for column in CODED_COLUMNS:
+            frame[column] = self.decoded(column)
+        frame["cost"] = self.costs()
+        return frame
+
+    def close(self):
+        """Delete the temporary directory of a ledger made without `spill_dir`, the ledger is empty and read-only afterwards"""
+        if self.owns_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.owns_dir = False
+            self.closed = True
+            self.parts = []
+            self.spilled = 0
+            self._new_chunk()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # Attributes can be missing when __init__ failed, and modules when the interpreter is exiting
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def save(self, path):
+        """Write the ledger to the directory `path`, reopen with UsageLedger.load.
+            Spilled chunks are moved there out of a temporary directory (copied out of a given `spill_dir`),
+            and later spills go there too.
+
+        Args:
+            path (str): Directory to write to
+        """
+        self.spill()
+        os.makedirs(path, exist_ok=True)
+        parts = []
+        for part in self.parts:
+            target = os.path.join(path, os.path.basename(part))
+            if os.path.abspath(part) != os.path.abspath(target):
+                (shutil.move if self.owns_dir else shutil.copyfile)(part, target)
+            parts.append(target)
+        with open(os.path.join(path, "ledger.json.tmp"), "w") as file:
+            json.dump({"chunk_size": self.chunk_size, "parts": [os.path.basename(part) for part in parts],
+                       "spilled": self.spilled, "values": self.values}, file)
+        os.replace(os.path.join(path, "ledger.json.tmp"), os.path.join(path, "ledger.json"))
+        if os.path.abspath(path) != os.path.abspath(self.spill_dir):
+            if self.owns_dir:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.owns_dir = False
+            self.spill_dir = path
+        self.parts = parts
+
+    @classmethod
+    def load(cls, path):
+        """Ledger written to the directory `path` by save, later spills are added to it"""
+        with open(os.path.join(path, "ledger.json")) as file:
+            meta = json.load(file)
+        ledger = cls(path, meta["chunk_size"])
+        ledger.parts = [os.path.join(path, part) for part in meta["parts"]]
+        ledger.spilled = meta["spilled"]
+        ledger.values = meta["values"]
+        ledger.codes = {column: {value: code for code, value in enumerate(values)} for column, values in meta["values"].items()}
+        return ledger
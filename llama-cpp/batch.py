@@ -0,0 +1,86 @@
+import os, time
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+
+from runner import run_prompt, PrefixCache
+from cache import CompletionCache
+from jsonlog import close_loggers
+from models import load_model
+
+# One model per worker process, created by the pool initializer
+_worker_llm = None
+_worker_log_path = None
+_worker_prefix_cache = None
+_worker_cache = None
+
+def _init_worker(model, log_path, reuse_prefix, cache_path, llm_kwargs):
+    global _worker_llm, _worker_log_path, _worker_prefix_cache, _worker_cache
+    _worker_llm = load_model(model, **llm_kwargs)
+    _worker_prefix_cache = PrefixCache(_worker_llm) if reuse_prefix else None
+    _worker_cache = CompletionCache(cache_path) if cache_path else None
+
+    # Each worker appends to its own raw log so entries never interleave
+    root, ext = os.path.splitext(log_path)
+    _worker_log_path = "{}_w{}{}".format(root, os.getpid(), ext)
+    # Pool workers skip atexit, drain the background logger when the worker exits
+    Finalize(None, close_loggers, exitpriority=10)
+
+def _run_chunk(job):
+    config_cls, token_limit, config_kwargs, run_kwargs, chunk = job
+    return [(pos, run_prompt(_worker_llm, config_cls(text, token_limit, **config_kwargs), _worker_log_path, prefix_cache=_worker_prefix_cache, cache=_worker_cache, row_id=row_id, **run_kwargs))
+            for pos, row_id, text in chunk]
+
+def run_batch(texts, config_cls, model, token_limit, log_path, workers=None, n_threads=None, chunk_size=8, max_tokens=100, stream=False, use_grammar=False, reuse_prefix=True, cache_path=None, row_ids=None, writer=None, **llm_kwargs):
+    """Classify texts across a pool of worker processes, each holding its own Llama instance
+
+    Args:
+        texts (iterable): Messages to classify, e.g. a DataFrame column
+        config_cls (type): Prompt config class (LlamaClassificationConfig, LlamaPurchaseReasonConfig, ...)
+        model (str): Registry key or gguf path of the model loaded by every worker
+        token_limit (int): Token limit passed to the prompt config
+        log_path (str): Path of the raw response log, suffixed per worker
+        workers (int, optional): Number of worker processes. Defaults to cpu_count // n_threads.
+        n_threads (int, optional): Threads per worker. Defaults to cpu_count // workers.
+        chunk_size (int, optional): Rows handed to a worker at a time. Defaults to 8.
+        max_tokens (int, optional): Maximum tokens to generate per row. Defaults to 100.
+        stream (bool, optional): Stream without echo and stop once the json answer is complete. Defaults to False.
+        use_grammar (bool, optional): Decode under the json grammar of the prompt config. Defaults to False.
+        reuse_prefix (bool, optional): Evaluate the static prompt prefix once per worker. Defaults to True.
+        cache_path (str, optional): SQLite completion cache shared by the workers. Defaults to None.
+        row_ids (list, optional): Stable id of each text, e.g. the DataFrame index. Defaults to the position.
+        writer (ResultWriter, optional): Writer receiving each result as soon as its chunk is done. Defaults to None.
+        **llm_kwargs: Llama arguments overriding the registry defaults (n_ctx, n_gpu_layers, ...)
+
+    Returns:
+        list: Parsed response items in the original order of texts
+    """
+    texts = list(texts)
+    row_ids = list(row_ids) if row_ids is not None else list(range(len(texts)))
+    cpu_count = os.cpu_count() or 1
+    if workers is None:
+        workers = max(1, cpu_count // (n_threads or 4))
+    if n_threads is None:
+        n_threads = max(1, cpu_count // workers)
+    llm_kwargs["n_threads"] = n_threads
+
+    indexed = [(pos, row_id, text) for pos, (row_id, text) in enumerate(zip(row_ids, texts))]
+    run_kwargs = dict(max_tokens=max_tokens, stream=stream)
+    jobs = [(config_cls, token_limit, dict(use_grammar=use_grammar), run_kwargs, indexed[i:i+chunk_size]) for i in range(0, len(indexed), chunk_size)]
+
+    print("Workers: {} x {} threads, Rows: {}".format(workers, n_threads, len(texts)))
+    start_time = time.time()
+    results = [None] * len(texts)
+    with mp.Pool(workers, initializer=_init_worker, initargs=(model, log_path, reuse_prefix, cache_path, llm_kwargs)) as pool:
+        for chunk_results in pool.imap_unordered(_run_chunk, jobs):
+            for pos, items in chunk_results:
+                results[pos] = items
+                if writer is not None:
+                    writer.write({writer.key: row_ids[pos], **items})
+        # Let the workers exit on their own so their loggers get drained
+        pool.close()
+        pool.join()
+    duration = time.time() - start_time
+
+    print("Processed {} rows in {:.1f}s ({:.2f} rows/s)".format(len(texts), duration, len(texts) / duration if duration else 0))
+    print("="*50)
+    return results
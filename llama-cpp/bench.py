@@ -0,0 +1,376 @@
+import io, os, re, sys, json, time, argparse, tempfile, resource, subprocess, contextlib
+from datetime import datetime
+
+from prompts import LlamaClassificationConfig, LlamaPurchaseReasonConfig
+from runner import run_prompt, PrefixCache
+from models import get_model, model_path
+import simplechat
+
+DATA_FILE = "../data/fine_food_reviews_1k.csv"
+TEXT_COLUMN = "Text"
+MAX_TOKENS = 200
+
+# Used when DATA_FILE is not available
+SAMPLE_TEXTS = [
+    "This has been the best tasting Stevia I have tried. I also think this is a better value than some of the others.",
+    "I subscribe to this monthly but just got an email stating that it's changing from 17 oz. to 16.9 oz.",
+    "The box arrived crushed and half of the cookies were broken. I would like a refund please.",
+    "Can you tell me if this tea contains any caffeine? The label does not say.",
+    "My dog loves these treats, but they are a bit expensive for the size of the bag.",
+    "Please cancel my order, I bought the wrong flavor by mistake.",
+    "Great coffee, smooth and not bitter at all. Will buy again.",
+    "The product was fine but shipping took almost three weeks.",
+]
+
+SAMPLE_PROMPTS = [
+    "What is the capital of Japan?",
+    "Write a haiku about coffee.",
+    "Explain what a KV cache is in one sentence.",
+    "Give me three names for a cat.",
+]
+
+# ===============
+# BACKENDS
+# ===============
+class StubLlama():
+    """Deterministic stand-in for Llama with a fixed cost per evaluated prompt token and per decoded token.
+        Keeps its own token history and only evaluates the prompt tokens that differ from it, like llama.cpp,
+        so prefix reuse, early stop and pre-tokenization show up in the numbers without a model.
+    """
+
+    # Shared by all instances, token ids are cached per model path (see CompiledTemplate.tokenize)
+    vocab = {"<s>": 1}
+    pieces = {1: ""}
+
+    def __init__(self, model_path="stub.gguf", prompt_eval_ms=0.2, decode_ms=5.0):
+        self.model_path = model_path
+        self.prompt_eval_ms = prompt_eval_ms
+        self.decode_ms = decode_ms
+        self.input_ids = []
+        self.n_tokens = 0
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [1] if add_bos else []
+        for piece in re.findall(r"\S+|\s", text.decode("utf-8", errors="ignore")):
+            if piece not in self.vocab:
+                self.vocab[piece] = len(self.vocab) + 1
+                self.pieces[self.vocab[piece]] = piece
+            tokens.append(self.vocab[piece])
+        return tokens
+
+    def detokenize(self, tokens):
+        return "".join(self.pieces[token] for token in tokens).encode("utf-8")
+
+    def n_ctx(self):
+        return 2048
+
+    def token_bos(self):
+        return 1
+
+    def token_eos(self):
+        return self.tokenize(b"</s>", add_bos=False)[0]
+
+    def reset(self):
+        self.input_ids = []
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        time.sleep(len(tokens) * self.prompt_eval_ms / 1000)
+        self.input_ids = self.input_ids + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return list(self.input_ids)
+
+    def load_state(self, state):
+        self.input_ids = list(state)
+        self.n_tokens = len(state)
+
+    def _answer(self, tokens):
+        prompt = self.detokenize(tokens).decode("utf-8")
+        if "CATEGORY" not in prompt:
+            return " This is a deterministic reply from the stub backend, it does not depend on the prompt.</s>"
+        categories = LlamaClassificationConfig.categories
+        category = categories[sum(tokens) % len(categories)]
+        return ' { "CATEGORY": "%s", "SUB-CATEGORY": ["Quality", "Price"]}\n\nThe message is about the product.\n```' % category
+
+    def _generate(self, tokens, max_tokens, stop):
+        # Only evaluate what differs from the current history
+        common = 0
+        for a, b in zip(self.input_ids, tokens[:-1]):
+            if a != b:
+                break
+            common += 1
+        self.input_ids = self.input_ids[:common]
+        self.eval(tokens[common:])
+
+        text = ""
+        for piece in re.findall(r"\S+|\s", self._answer(tokens))[:max_tokens]:
+            time.sleep(self.decode_ms / 1000)
+            self.input_ids.append(self.tokenize(piece.encode("utf-8"), add_bos=False)[0])
+            self.n_tokens = len(self.input_ids)
+            text += piece
+            hit = [s for s in stop if s in text]
+            if hit:
+                # Drop the stop string and anything after it
+                yield piece[:max(0, text.index(hit[0]) - (len(text) - len(piece)))], "stop"
+                return
+            yield piece, None
+        yield "", "length"
+
+    def create_completion(self, prompt, max_tokens=16, stop=None, echo=False, stream=False, **kwargs):
+        tokens = prompt if isinstance(prompt, list) else self.tokenize(prompt.encode("utf-8"))
+        chunks = ({"choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": reason}]}
+                  for text, reason in self._generate(tokens, max_tokens, stop or []))
+        if stream:
+            return chunks
+        return assemble_response(self, prompt, tokens, chunks, echo)
+
+    __call__ = create_completion
+
+class TimedLlama():
+    """Wraps a model and times every completion: time-to-first-token, prompt-eval and decode throughput.
+        Calls are always streamed underneath to catch the first token, non-streamed responses are assembled here.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _timed(self, prompt, tokens, **kwargs):
+        reused = reused_tokens(self.llm, tokens)
+        start_time = time.time()
+        first_time = None
+        completion_tokens = 0
+        try:
+            for chunk in self.llm.create_completion(prompt, stream=True, **kwargs):
+                if first_time is None:
+                    first_time = time.time()
+                completion_tokens += 1
+                yield chunk
+        finally:
+            # Also runs when the caller stops the stream early
+            end_time = time.time()
+            self.calls.append({
+                "prompt_tokens": len(tokens),
+                "reused_tokens": reused,
+                "completion_tokens": completion_tokens,
+                "ttft": (first_time or end_time) - start_time,
+                "total": end_time - start_time,
+            })
+
+    def create_completion(self, prompt, stream=False, echo=False, **kwargs):
+        tokens = prompt if isinstance(prompt, list) else self.llm.tokenize(prompt.encode("utf-8"))
+        chunks = self._timed(prompt, tokens, **kwargs)
+        if stream:
+            return chunks
+        return assemble_response(self.llm, prompt, tokens, chunks, echo)
+
+    __call__ = create_completion
+
+def reused_tokens(llm, tokens):
+    """Prompt tokens the model will not evaluate again: the common prefix of its token history and the prompt,
+        short of the last token, as llama.cpp does. 0 for a model server, whose history is not visible here.
+    """
+    if not hasattr(llm, "input_ids"):
+        return 0
+    common = 0
+    for a, b in zip(llm.input_ids[:llm.n_tokens], tokens[:-1]):
+        if a != b:
+            break
+        common += 1
+    return common
+
+def assemble_response(llm, prompt, tokens, chunks, echo):
+    """Build a non-streamed completion response from streamed chunks"""
+    text = ""
+    finish_reason = None
+    completion_tokens = 0
+    for chunk in chunks:
+        text += chunk["choices"][0]["text"]
+        finish_reason = chunk["choices"][0]["finish_reason"] or finish_reason
+        completion_tokens += 1
+    if echo:
+        text = (prompt if isinstance(prompt, str) else llm.detokenize(tokens).decode("utf-8", errors="ignore")) + text
+    return {
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": len(tokens), "completion_tokens": completion_tokens, "total_tokens": len(tokens) + completion_tokens},
+    }
+
+def load_backend(model, server=None):
+    if model == "stub":
+        return StubLlama()
+    return get_model(model, server=server)
+
+# ===============
+# METRICS
+# ===============
+def percentile(values, p):
+    """Nearest-rank percentile
+
+    Args:
+        values (list): Samples
+        p (float): Percentile between 0 and 100
+
+    Returns:
+        float: The percentile, None without samples
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+def summarize(latencies, calls):
+    """Aggregate per-row latencies and per-call timings of a scenario
+
+    Args:
+        latencies (list): Seconds per row
+        calls (list): TimedLlama call records
+
+    Returns:
+        dict: Throughput and latency metrics
+    """
+    prompt_tokens = sum(c["prompt_tokens"] for c in calls)
+    # Only the tokens evaluated count toward throughput, the reused prefix costs nothing
+    evaluated_tokens = prompt_tokens - sum(c.get("reused_tokens", 0) for c in calls)
+    decode_tokens = sum(max(0, c["completion_tokens"] - 1) for c in calls)
+    decode_time = sum(c["total"] - c["ttft"] for c in calls)
+    # The first token is decoded before it arrives, its share of the time to first token is taken off
+    first_decode = decode_time / decode_tokens if decode_tokens else 0
+    prompt_time = sum(max(0, c["ttft"] - first_decode) for c in calls)
+    ttfts = [c["ttft"] for c in calls]
+    return {
+        "rows": len(latencies),
+        "rows_per_s": round(len(latencies) / sum(latencies), 3) if sum(latencies) else None,
+        "prompt_tokens": prompt_tokens,
+        "evaluated_prompt_tokens": evaluated_tokens,
+        "prompt_eval_tokens_per_s": round(evaluated_tokens / prompt_time, 1) if prompt_time else None,
+        "decode_tokens_per_s": round(decode_tokens / decode_time, 1) if decode_time else None,
+        "ttft_p50_ms": round(percentile(ttfts, 50) * 1000, 1) if ttfts else None,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+# ===============
+# SCENARIOS
+# ===============
+def bench_simplechat(llm, prompts):
+    # One conversation, each turn extends the context of the previous one
+    session = simplechat.ChatSession(llm)
+    latencies = []
+    for prompt in prompts:
+        start_time = time.time()
+        simplechat.get_reply(session, prompt)
+        latencies.append(time.time() - start_time)
+    return latencies
+
+def bench_runner(llm, config_cls, texts, log_path, stream=True, use_grammar=False, reuse_prefix=True):
+    # A model server keeps its own state, the prefix is only restored on local models
+    prefix_cache = PrefixCache(llm) if reuse_prefix and hasattr(llm, "save_state") else None
+    latencies = []
+    for row_id, text in enumerate(texts):
+        start_time = time.time()
+        run_prompt(llm, config_cls(text, MAX_TOKENS, use_grammar=use_grammar), log_path, prefix_cache=prefix_cache, stream=stream, row_id=row_id)
+        latencies.append(time.time() - start_time)
+    return latencies
+
+def load_texts(rows):
+    if os.path.exists(DATA_FILE):
+        import pandas as pd
+        texts = pd.read_csv(DATA_FILE, index_col=False)[TEXT_COLUMN].head(rows).tolist()
+    else:
+        texts = SAMPLE_TEXTS
+    return [texts[i % len(texts)] for i in range(rows)]
+
+def run(model, rows=20, stream=True, use_grammar=False, reuse_prefix=True, server=None, scenarios=("simplechat", "classification", "purchasereason")):
+    """Run the benchmark scenarios against one model
+
+    Args:
+        model (str): Registry key or gguf path, or "stub" for the deterministic stub backend
+        rows (int, optional): Rows (or chat prompts) per scenario. Defaults to 20.
+        stream (bool, optional): Run the classification runners in streaming mode. Defaults to True.
+        use_grammar (bool, optional): Decode under the category grammar (real models only). Defaults to False.
+        reuse_prefix (bool, optional): Reuse the evaluated prompt prefix. Defaults to True.
+        server (tuple, optional): Address of a model server to run against. Defaults to None (load here).
+        scenarios (tuple, optional): Scenarios to run.
+
+    Returns:
+        dict: One result record, with the metrics of each scenario
+    """
+    texts = load_texts(rows)
+    log_path = os.path.join(tempfile.mkdtemp(prefix="bench_"), "bench_raw.jsonl")
+    llm = TimedLlama(load_backend(model, server=server))
+    path = llm.model_path
+    quant = re.search(r"Q\d\w*", os.path.basename(path))
+
+    results = {}
+    for name in scenarios:
+        llm.calls = []
+        # The scripts print every row, keep that out of the measurement output
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name == "simplechat":
+                latencies = bench_simplechat(llm, [SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)] for i in range(rows)])
+            else:
+                config_cls = LlamaClassificationConfig if name == "classification" else LlamaPurchaseReasonConfig
+                latencies = bench_runner(llm, config_cls, texts, log_path, stream=stream, use_grammar=use_grammar, reuse_prefix=reuse_prefix)
+        results[name] = summarize(latencies, llm.calls)
+        print(name, json.dumps(results[name]))
+
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "model": os.path.basename(path),
+        "quant": quant.group(0) if quant else None,
+        "options": {"rows": rows, "stream": stream, "use_grammar": use_grammar, "reuse_prefix": reuse_prefix},
+        "scenarios": results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results_file, metric="latency_p50_ms"):
+    """Print one metric of every recorded run side by side
+
+    Args:
+        results_file (str): JSONL file written by this benchmark
+        metric (str, optional): Metric to compare. Defaults to "latency_p50_ms".
+    """
+    with open(results_file) as file:
+        runs = [json.loads(line) for line in file if line.strip()]
+    for run in runs:
+        values = ", ".join("{}={}".format(name, m.get(metric)) for name, m in run["scenarios"].items())
+        print("{} {} {} {}: {}".format(run["time"], run["commit"], run["model"], metric, values))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline inference benchmark for the llama-cpp scripts")
+    parser.add_argument("models", nargs="*", default=["stub"], help='registry keys, gguf model paths, or "stub" (default)')
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--grammar", action="store_true")
+    parser.add_argument("--no-prefix", action="store_true")
+    parser.add_argument("--server", metavar="HOST:PORT", help="run against a model server instead of loading the models")
+    parser.add_argument("--out", default="./bench_results.jsonl", help="results are appended as one json line per run")
+    parser.add_argument("--compare", metavar="METRIC", help="print METRIC of every run in --out instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.out, args.compare)
+    else:
+        server = (args.server.rsplit(":", 1)[0], int(args.server.rsplit(":", 1)[1])) if args.server else None
+        for model in args.models:
+            result = run(model, rows=args.rows, stream=not args.no_stream, use_grammar=args.grammar, reuse_prefix=not args.no_prefix, server=server)
+            with open(args.out, "a") as file:
+                file.write(json.dumps(result) + "\n")
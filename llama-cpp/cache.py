@@ -0,0 +1,106 @@
+import os, json, time, sqlite3, hashlib
+
+class CompletionCache():
+    """Persistent completion cache in SQLite, keyed on a hash of the model and call arguments.
+        Only deterministic calls (temperature=0) are cached.
+        The least recently used entries are evicted once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            path (str): Path of the SQLite file
+            max_bytes (int, optional): Size limit of the stored responses. Defaults to 512MB.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        # WAL lets the batch workers read and write the same file concurrently
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS completions (
+            key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, last_used REAL)""")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(model_path, prompt, **params):
+        """Hash the model and call arguments into a cache key
+
+        Args:
+            model_path (str): Path of the model
+            prompt (str): Rendered prompt
+            **params: Generation arguments (temperature, max_tokens, stop, ...)
+
+        Returns:
+            str: sha256 hex digest
+        """
+        payload = json.dumps({"model": os.path.basename(model_path), "prompt": prompt, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, params):
+        return params.get("temperature", 0) == 0
+
+    def get(self, key):
+        """Look up a cached response
+
+        Args:
+            key (str): Key from make_key
+
+        Returns:
+            dict: The cached response, or None on a miss
+        """
+        row = self.db.execute("SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """Store a response and evict old entries if over the size limit
+
+        Args:
+            key (str): Key from make_key
+            response (dict): Llama completion response
+        """
+        data = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)", (key, data, len(data), now, now))
+        self.evict()
+        self.db.commit()
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used entries until back under the limit
+        for key, size in self.db.execute("SELECT key, size FROM completions ORDER BY last_used").fetchall():
+            self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        """Hit/miss counters of this process and the size of the cache
+
+        Returns:
+            dict: hits, misses, hit_rate, entries and bytes
+        """
+        entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def close(self):
+        self.db.close()
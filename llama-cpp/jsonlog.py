@@ -0,0 +1,183 @@
+import os, sys, glob, gzip, json, time, queue, atexit, argparse, threading
+
+# Marks a queue.get that timed out, so a partial batch gets written
+_TIMEOUT = object()
+
+def _to_json(value):
+    # numpy scalars (e.g. DataFrame index values) and anything else json can't encode
+    return value.item() if hasattr(value, "item") else str(value)
+
+class JsonlLogger():
+    """Background JSONL logger. Records go into a bounded queue drained by a writer thread,
+        which writes compact json lines in batches, optionally gzip compressed, rotating files by size.
+    """
+
+    def __init__(self, path, max_queue=10000, batch_size=100, flush_interval=1.0, compress=False, max_bytes=100 * 1024 * 1024):
+        """
+        Args:
+            path (str): Base path of the log, e.g. ./logs/run_raw.jsonl
+            max_queue (int, optional): Records held before log() blocks. Defaults to 10000.
+            batch_size (int, optional): Records written at a time. Defaults to 100.
+            flush_interval (float, optional): Seconds before a partial batch is written. Defaults to 1.0.
+            compress (bool, optional): Write gzip files. Defaults to False.
+            max_bytes (int, optional): Size at which the log rotates to a new file. Defaults to 100MB.
+        """
+        self.root, self.ext = os.path.splitext(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.part = len(log_files(path))
+        self.file = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, record):
+        """Queue a record, blocking only if the writer thread falls behind by max_queue records
+
+        Args:
+            record (dict): JSON serializable record
+        """
+        self.queue.put(record)
+
+    def flush(self):
+        """Wait until every queued record is written"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _open(self):
+        path = "{}.{:03d}{}".format(self.root, self.part, self.ext) + (".gz" if self.compress else "")
+        self.file = gzip.open(path, "at", encoding="utf-8") if self.compress else open(path, "a", encoding="utf-8")
+        self.path = path
+
+    def _write(self, batch):
+        if self.file is None:
+            self._open()
+        self.file.write("".join(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=_to_json) + "\n" for record in batch))
+        self.file.flush()
+
+        if os.path.getsize(self.path) >= self.max_bytes:
+            self.file.close()
+            self.file = None
+            self.part += 1
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                record = self.queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                record = _TIMEOUT
+
+            closing = record is None
+            if not closing and record is not _TIMEOUT:
+                batch.append(record)
+            if batch and (closing or len(batch) >= self.batch_size or time.time() >= deadline):
+                self._write(batch)
+                for _ in batch:
+                    self.queue.task_done()
+                batch = []
+            if time.time() >= deadline:
+                deadline = time.time() + self.flush_interval
+            if closing:
+                self.queue.task_done()
+                if self.file:
+                    self.file.close()
+                return
+
+def log_files(path):
+    """Files written by a logger with this base path, in order
+
+    Args:
+        path (str): Base path of the log
+
+    Returns:
+        list: Paths of the log files
+    """
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob("{}.[0-9][0-9][0-9]{}".format(glob.escape(root), ext)) + glob.glob("{}.[0-9][0-9][0-9]{}.gz".format(glob.escape(root), ext)))
+
+def read_log(path):
+    """Iterate over the records of a log file
+
+    Args:
+        path (str): Log file, plain or gzip
+
+    Yields:
+        dict: Logged records
+    """
+    with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")) as file:
+        for line in file:
+            # The last line of a crashed run may be cut short
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+# One logger per path, shared by every caller in the process
+_loggers = {}
+_lock = threading.Lock()
+
+def get_logger(path, **kwargs):
+    """Shared logger of a path, created on first use
+
+    Args:
+        path (str): Base path of the log
+        **kwargs: JsonlLogger arguments used on creation
+
+    Returns:
+        JsonlLogger: The logger
+    """
+    with _lock:
+        if path not in _loggers:
+            _loggers[path] = JsonlLogger(path, **kwargs)
+        return _loggers[path]
+
+def close_loggers():
+    with _lock:
+        for logger in _loggers.values():
+            logger.close()
+        _loggers.clear()
+
+atexit.register(close_loggers)
+
+def replay(log_paths, out_file, key="row_id"):
+    """Rebuild a result csv (or parquet) from logged classification records
+
+    Args:
+        log_paths (list): Log files to read, in order
+        out_file (str): Output file, written with ResultWriter
+        key (str, optional): Row id column. Defaults to "row_id".
+
+    Returns:
+        int: Number of rows written
+    """
+    from writer import ResultWriter
+
+    count = 0
+    with ResultWriter(out_file, key=key) as writer:
+        done = writer.done_keys()
+        for path in log_paths:
+            for record in read_log(path):
+                if "items" not in record or str(record.get(key)) in done:
+                    continue
+                writer.write({key: record.get(key), **record["items"]})
+                done.add(str(record.get(key)))
+                count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild result csv from JSONL response logs")
+    parser.add_argument("logs", nargs="+", help="log files or base log paths")
+    parser.add_argument("out_file", help="output csv, or .parquet")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.logs:
+        paths += [path] if os.path.exists(path) else log_files(path)
+    print("Rows written:", replay(paths, args.out_file), file=sys.stderr)
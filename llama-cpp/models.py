@@ -0,0 +1,331 @@
+import os, sys, stat, secrets, argparse, ipaddress, threading
+from dataclasses import dataclass
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+MODEL_DIR = os.environ.get("LLAMA_MODEL_DIR", "/home/catsmile/models")
+SERVER_ADDRESS = ("localhost", 6060)
+# Secret shared by the model server and its clients, random per install. Connections are pickles,
+# whoever holds the key can run code as the server user, so it is never stored in the repo.
+AUTHKEY_FILE = os.environ.get("LLAMA_SERVER_KEY_FILE", os.path.expanduser("~/.config/llama-cpp/server.key"))
+# Llama arguments a client may change on the server, anything else (model_path, ...) is refused
+SERVER_OVERRIDES = ("n_ctx", "n_batch", "n_threads", "seed")
+
+@dataclass
+class ModelSpec:
+    """Where a model lives and the Llama arguments it is loaded with by default"""
+    file: str
+    n_ctx: int = 700
+    n_threads: int = None # None for os.cpu_count()
+    n_gpu_layers: int = -1 # 0 for no GPU, -1 to offload everything to GPU
+    use_mmap: bool = True # map the weights instead of reading them, reloads come from the page cache
+    use_mlock: bool = False # pin the weights in RAM so they are never swapped out
+
+    @property
+    def path(self):
+        return self.file if os.path.isabs(self.file) or self.file.endswith(".gguf") else os.path.join(MODEL_DIR, self.file + ".gguf")
+
+MODELS = {
+    "LLAMA13B_Q4": ModelSpec("llama-2-13b-chat.Q4_K_M", n_threads=10),
+    "LLAMA13B_Q5": ModelSpec("llama-2-13b-chat.Q5_K_M", n_threads=5),
+    "LLAMA7B_Q4": ModelSpec("llama-2-7b-chat.Q4_K_M"),
+    "LLAMA7B_Q5": ModelSpec("llama-2-7b-chat.Q5_K_M"),
+    "WIZLM_Q5": ModelSpec("Wizard-Vicuna-13B-Uncensored.Q5_K_M"),
+}
+
+def get_spec(model):
+    """Registry entry of a model
+
+    Args:
+        model (str): Registry key (e.g. "LLAMA13B_Q4") or path of a gguf file
+
+    Returns:
+        ModelSpec: The registry entry, or default settings for a plain path
+    """
+    return MODELS[model] if model in MODELS else ModelSpec(model)
+
+def model_path(model):
+    return get_spec(model).path
+
+def llama_kwargs(model, **overrides):
+    """Llama arguments of a model, registry defaults updated with `overrides`
+
+    Args:
+        model (str): Registry key or path of a gguf file
+        **overrides: Llama arguments to change (n_ctx, n_threads, ...)
+
+    Returns:
+        dict: Keyword arguments for Llama
+    """
+    spec = get_spec(model)
+    kwargs = dict(
+        model_path=spec.path,
+        n_ctx=spec.n_ctx,
+        n_threads=spec.n_threads or os.cpu_count(),
+        n_gpu_layers=spec.n_gpu_layers,
+        use_mmap=spec.use_mmap,
+        use_mlock=spec.use_mlock,
+        verbose=False,
+    )
+    kwargs.update(overrides)
+    return kwargs
+
+# Loaded models of this process, keyed on their Llama arguments
+_models = {}
+_models_lock = threading.Lock()
+
+def load_model(model, **overrides):
+    """Load a model on first use and keep it for the life of the process
+
+    Args:
+        model (str): Registry key or path of a gguf file
+        **overrides: Llama arguments to change (n_ctx, n_threads, ...)
+
+    Returns:
+        Llama: The loaded model
+    """
+    kwargs = llama_kwargs(model, **overrides)
+    key = tuple(sorted(kwargs.items()))
+    with _models_lock:
+        if key not in _models:
+            from llama_cpp import Llama
+            _models[key] = Llama(**kwargs)
+        return _models[key]
+
+def get_model(model, server=None, **overrides):
+    """Model to run prompts on, loaded here or held by a resident model server
+
+    Args:
+        model (str): Registry key or path of a gguf file
+        server (tuple or str, optional): Address of a server started with `python models.py serve`. Defaults to None (load here).
+        **overrides: Llama arguments to change (n_ctx, n_threads, ...)
+
+    Returns:
+        Llama or RemoteLlama: The model
+    """
+    if server is not None:
+        return RemoteLlama(model, server, **overrides)
+    return load_model(model, **overrides)
+
+# ===============
+# MODEL SERVER
+# ===============
+def get_authkey(path=AUTHKEY_FILE):
+    """Key of the model server, from $LLAMA_SERVER_KEY or a file only the user can read, created on first use
+
+    Args:
+        path (str, optional): Key file. Defaults to AUTHKEY_FILE.
+
+    Returns:
+        bytes: The key
+    """
+    if os.environ.get("LLAMA_SERVER_KEY"):
+        return os.environ["LLAMA_SERVER_KEY"].encode("utf-8")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass # created at the same time by another process
+        else:
+            with os.fdopen(fd, "w") as file:
+                file.write(secrets.token_hex(32))
+    if os.stat(path).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise PermissionError("{} can be read by other users, chmod 600 it".format(path))
+    with open(path) as file:
+        return file.read().strip().encode("utf-8")
+
+def is_loopback(address):
+    """True for a unix socket path or a host that only accepts connections from this machine"""
+    if isinstance(address, str):
+        return True
+    host = address[0]
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class RemoteLlama():
+    """Client of a resident model server with the completion interface of Llama.
+        The server keeps its llama.cpp state between requests, so consecutive prompts sharing
+        a prefix only evaluate the part that differs, as they would on a local model.
+    """
+
+    remote = True
+
+    def __init__(self, model, address=SERVER_ADDRESS, authkey=None, **overrides):
+        """
+        Args:
+            model (str): Registry key, or a gguf file the server preloaded
+            address (tuple or str, optional): Server address, (host, port) or a unix socket path. Defaults to SERVER_ADDRESS.
+            authkey (bytes, optional): Shared key of the server. Defaults to get_authkey().
+            **overrides: Llama arguments to change (n_ctx, n_threads, ...)
+        """
+        self.model = model
+        self.overrides = overrides
+        self.model_path = model_path(model)
+        self.conn = Client(address, authkey=authkey or get_authkey())
+        self.lock = threading.Lock()
+
+    def _request(self, method, *args, **kwargs):
+        with self.lock:
+            self.conn.send((method, self.model, self.overrides, args, kwargs))
+            return self._receive()
+
+    def _receive(self):
+        status, value = self.conn.recv()
+        if status == "error":
+            raise RuntimeError("model server: " + value)
+        return value
+
+    def _stream(self, args, kwargs):
+        with self.lock:
+            self.conn.send(("create_completion", self.model, self.overrides, args, kwargs))
+            done = False
+            try:
+                while True:
+                    status, value = self.conn.recv()
+                    if status == "end":
+                        done = True
+                        return
+                    if status == "error":
+                        done = True
+                        raise RuntimeError("model server: " + value)
+                    yield value
+            finally:
+                # The caller stopped early, have the server stop generating and drain what is in flight
+                if not done:
+                    self.conn.send("stop")
+                    while self.conn.recv()[0] not in ("end", "error"):
+                        pass
+
+    def create_completion(self, prompt, stream=False, **kwargs):
+        if stream:
+            return self._stream((prompt,), dict(kwargs, stream=True))
+        return self._request("create_completion", prompt, **kwargs)
+
+    __call__ = create_completion
+
+    def create_chat_completion(self, messages, **kwargs):
+        return self._request("create_chat_completion", messages, **kwargs)
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return self._request("tokenize", text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens):
+        return self._request("detokenize", tokens)
+
+    def n_ctx(self):
+        return self._request("n_ctx")
+
+    def token_bos(self):
+        return self._request("token_bos")
+
+    def token_eos(self):
+        return self._request("token_eos")
+
+    def close(self):
+        self.conn.close()
+
+class ModelServer():
+    """Keeps models loaded in one process and serves them to scripts over a local socket.
+        Each connection gets a thread; calls on the same model are serialized since a
+        llama.cpp context runs one sequence at a time.
+        Clients can only use registry models and the ones preloaded at start, and change SERVER_OVERRIDES.
+    """
+
+    methods = ("create_completion", "create_chat_completion", "tokenize", "detokenize", "n_ctx", "token_bos", "token_eos")
+
+    def __init__(self, address=SERVER_ADDRESS, authkey=None):
+        if not is_loopback(address):
+            raise ValueError("the model server only listens on loopback or a unix socket, not {}".format(address[0]))
+        self.address = address
+        self.authkey = authkey or get_authkey()
+        self.locks = {}
+        self.allowed = set(MODELS)
+
+    def preload(self, model, **overrides):
+        load_model(model, **overrides)
+        self.allowed.add(model)
+        print("Loaded", model_path(model), file=sys.stderr)
+
+    def _lock(self, llm):
+        with _models_lock:
+            return self.locks.setdefault(id(llm), threading.Lock())
+
+    def _handle(self, conn, method, model, overrides, args, kwargs):
+        from runner import compile_grammar
+
+        if method not in self.methods:
+            raise ValueError("unknown method " + str(method))
+        if model not in self.allowed:
+            raise ValueError("model {} is not served, preload it on start".format(model))
+        refused = set(overrides) - set(SERVER_OVERRIDES)
+        if refused:
+            raise ValueError("overrides not allowed: " + ", ".join(sorted(refused)))
+        llm = load_model(model, **overrides)
+        # Grammars travel as GBNF text, parsed (once) on this side
+        if isinstance(kwargs.get("grammar"), str):
+            kwargs["grammar"] = compile_grammar(kwargs["grammar"])
+
+        with self._lock(llm):
+            if not kwargs.get("stream"):
+                conn.send(("result", getattr(llm, method)(*args, **kwargs)))
+                return
+            for chunk in getattr(llm, method)(*args, **kwargs):
+                if conn.poll() and conn.recv() == "stop":
+                    break
+                conn.send(("chunk", chunk))
+            conn.send(("end", None))
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if request == "stop":
+                    # A stop that arrived after its stream had already ended
+                    continue
+                try:
+                    self._handle(conn, *request)
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    conn.send(("error", "{}: {}".format(type(e).__name__, e)))
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print("Model server listening on", listener.address, file=sys.stderr)
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    print("Refused a connection:", e, file=sys.stderr)
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Model registry and resident model server")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="print the registry")
+    serve = sub.add_parser("serve", help="keep models loaded and serve them on a local socket")
+    serve.add_argument("models", nargs="*", help="registry keys or gguf paths to load on start (others load on first request)")
+    serve.add_argument("--host", default=SERVER_ADDRESS[0], help="loopback address to listen on")
+    serve.add_argument("--port", type=int, default=SERVER_ADDRESS[1])
+    serve.add_argument("--socket", help="unix socket path to listen on instead of --host/--port")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for key, spec in MODELS.items():
+            print("{:<12} {} {}".format(key, spec.path, "" if os.path.exists(spec.path) else "(missing)"))
+    else:
+        if not args.socket and not is_loopback((args.host, args.port)):
+            parser.error("--host must be a loopback address, the server runs code sent by whoever holds the key")
+        server = ModelServer(args.socket or (args.host, args.port))
+        for model in args.models:
+            server.preload(model)
+        server.serve_forever()
@@ -0,0 +1,415 @@
+import os, re, sys, json, time, uuid, queue, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from models import MODELS, llama_kwargs, model_path
+from runner import compile_grammar
+
+CHAT_STOP = ["</s>", "<s>", "[INST]", "[/INST]"]
+FUNCTIONS_PROMPT = """
+
+You can call the following functions:
+{functions}
+To call a function, answer with only a json object of the form {{"name": <function name>, "arguments": <arguments object>}}"""
+
+JSON_GRAMMAR = r"""
+value ::= object | array | string | number | ("true" | "false" | "null")
+object ::= "{" ws ( string ws ":" ws value ws ( "," ws string ws ":" ws value ws )* )? "}"
+array ::= "[" ws ( value ws ( "," ws value ws )* )? "]"
+string ::= "\"" ( [^"\\] | "\\" ["\\/bfnrtu] )* "\""
+number ::= "-"? [0-9]+ ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )?
+ws ::= [ \t\n]*
+"""
+
+# ===============
+# SCHEDULER
+# ===============
+class Job():
+    """One completion request. Results are put on `out` as ("chunk", chunk), ("result", response) or ("error", message),
+        a stream ends with ("end", None)
+    """
+
+    def __init__(self, prompt, params, stream=False):
+        self.prompt = prompt
+        self.params = params
+        self.stream = stream
+        self.skipped = 0 # times a later request was taken first
+        self.out = queue.Queue()
+        # Identical deterministic requests share one completion
+        self.key = None if stream or params.get("temperature", 1) != 0 else json.dumps([prompt, params], sort_keys=True, default=str)
+
+class Scheduler():
+    """Request queue in front of a set of llama.cpp contexts ("slots") of one model.
+        A context decodes a single sequence, so concurrent requests are spread over the slots.
+        A free slot takes the waiting request sharing the longest prefix with the prompt it last evaluated,
+        so llama.cpp only evaluates the part that differs, and identical deterministic requests are answered together.
+        A request passed over `max_skips` times is taken next whatever its prompt, so none waits forever.
+    """
+
+    def __init__(self, model, slots=1, max_skips=4, **overrides):
+        """
+        Args:
+            model (str): Registry key or gguf path
+            slots (int, optional): llama.cpp contexts to run in parallel. Defaults to 1.
+            max_skips (int, optional): Times a request can be passed over for one sharing a longer prefix. Defaults to 4.
+            **overrides: Llama arguments overriding the registry defaults (n_ctx, n_threads, ...)
+        """
+        from llama_cpp import Llama
+
+        kwargs = llama_kwargs(model, **overrides)
+        # Every slot is a separate Llama with its own context. On CPU the memory-mapped weights are shared
+        # through the page cache, but layers offloaded to the GPU (n_gpu_layers) are copied once per slot
+        kwargs["n_threads"] = max(1, kwargs["n_threads"] // slots)
+        self.model = model
+        self.max_skips = max_skips
+        self.pending = []
+        self.cond = threading.Condition()
+        self.llms = [Llama(**kwargs) for _ in range(slots)]
+        for llm in self.llms:
+            threading.Thread(target=self._run_slot, args=(llm,), daemon=True).start()
+
+    def submit(self, prompt, params, stream=False):
+        job = Job(prompt, params, stream)
+        with self.cond:
+            self.pending.append(job)
+            self.cond.notify()
+        return job
+
+    def _next(self, last_prompt):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            # Pending requests are in arrival order, the first one has waited longest
+            if self.pending[0].skipped >= self.max_skips:
+                job = self.pending[0]
+            else:
+                job = max(self.pending, key=lambda j: len(os.path.commonprefix([j.prompt, last_prompt])))
+            for j in self.pending[:self.pending.index(job)]:
+                j.skipped += 1
+            jobs = [j for j in self.pending if j is job or (job.key is not None and j.key == job.key)]
+            self.pending = [j for j in self.pending if j not in jobs]
+            return jobs
+
+    def _run_slot(self, llm):
+        last_prompt = ""
+        while True:
+            jobs = self._next(last_prompt)
+            job = jobs[0]
+            last_prompt = job.prompt
+            params = dict(job.params)
+            if params.get("grammar"):
+                params["grammar"] = compile_grammar(params["grammar"])
+            try:
+                if job.stream:
+                    for chunk in llm.create_completion(job.prompt, stream=True, **params):
+                        job.out.put(("chunk", chunk))
+                    job.out.put(("end", None))
+                else:
+                    response = llm.create_completion(job.prompt, **params)
+                    for j in jobs:
+                        j.out.put(("result", response))
+            except Exception as e:
+                for j in jobs:
+                    j.out.put(("error", "{}: {}".format(type(e).__name__, e)))
+
+def _number(body, name, default, low, high, integer=False):
+    """Field of a request checked to be a number in [low, high], a ValueError is answered with a 400"""
+    value = body.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) or not low <= value <= high:
+        raise ValueError("{} must be {} between {} and {}, got {!r}".format(name, "an integer" if integer else "a number", low, high, value))
+    return value
+
+def completion_params(body, max_tokens=16):
+    """llama.cpp generation arguments from the fields of an OpenAI request
+
+    Raises:
+        ValueError: A field has the wrong type or is out of range
+    """
+    stop = body.get("stop") or []
+    stop = [stop] if isinstance(stop, str) else stop
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise ValueError("stop must be a string or a list of strings")
+    params = dict(
+        max_tokens=_number(body, "max_tokens", max_tokens, 1, 2**31 - 1, integer=True),
+        temperature=_number(body, "temperature", 1, 0, 2),
+        top_p=_number(body, "top_p", 1, 0, 1),
+        stop=list(stop),
+        presence_penalty=_number(body, "presence_penalty", 0, -2, 2),
+        frequency_penalty=_number(body, "frequency_penalty", 0, -2, 2),
+    )
+    if body.get("seed") is not None:
+        params["seed"] = _number(body, "seed", None, -2**63, 2**63 - 1, integer=True)
+    return params
+
+# ===============
+# CHAT FORMAT
+# ===============
+def chat_prompt(messages, functions=None):
+    """Render OpenAI chat messages in the llama-2 chat format
+
+    Args:
+        messages (list): OpenAI chat messages (system, user, assistant, function and tool roles)
+        functions (list, optional): OpenAI function definitions, described in the system prompt. Defaults to None.
+
+    Returns:
+        str: The prompt
+    """
+    system = "\n".join(m["content"] for m in messages if m["role"] == "system" and m.get("content"))
+    if functions:
+        system += FUNCTIONS_PROMPT.format(functions=json.dumps(functions, ensure_ascii=False))
+
+    prompt = ""
+    turn = []
+    for m in messages:
+        if m["role"] == "system":
+            continue
+        if m["role"] == "assistant":
+            content = m.get("content") or ""
+            calls = [m["function_call"]] if m.get("function_call") else [t["function"] for t in m.get("tool_calls") or []]
+            if calls:
+                # Shown to the model in the same form it is asked to answer in
+                content = "\n".join(json.dumps({"name": call["name"], "arguments": json.loads(call["arguments"]) if isinstance(call.get("arguments"), str) else call.get("arguments")},
+                                                ensure_ascii=False) for call in calls)
+            prompt += format_turn(turn, system if not prompt else "") + " " + content + " </s>"
+            turn = []
+        elif m["role"] in ("function", "tool"):
+            turn.append("Function {} returned: {}".format(m.get("name") or m.get("tool_call_id"), m.get("content")))
+        else:
+            turn.append(m.get("content") or "")
+    return prompt + format_turn(turn, system if not prompt else "")
+
+def format_turn(lines, system=""):
+    sys_block = "<<SYS>>\n{}\n<</SYS>>\n\n".format(system.strip()) if system.strip() else ""
+    return "<s>[INST] {}{} [/INST]".format(sys_block, "\n".join(lines))
+
+def function_grammar(name):
+    """GBNF grammar of a call to one function: {"name": name, "arguments": {...}}
+
+    Raises:
+        ValueError: The name is not a valid function name, it would be pasted as is into the grammar
+    """
+    # The names the OpenAI API accepts, none needs escaping in a GBNF string
+    if not isinstance(name, str) or not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", name):
+        raise ValueError("function name must be 1 to 64 letters, digits, underscores or dashes, got {!r}".format(name))
+    return '\nroot ::= "{" ws "\\"name\\"" ws ":" ws "\\"' + name + '\\"" ws "," ws "\\"arguments\\"" ws ":" ws object ws "}"' + JSON_GRAMMAR
+
+def parse_function_call(text, functions):
+    """The function call in a chat answer, None if the answer is plain text"""
+    text = text.strip()
+    if not text.startswith("{"):
+        return None
+    try:
+        call = json.loads(text[:text.rindex("}") + 1])
+    except ValueError:
+        return None
+    if not isinstance(call, dict) or call.get("name") not in [f["name"] for f in functions]:
+        return None
+    return {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}), ensure_ascii=False)}
+
+# ===============
+# HTTP
+# ===============
+class OpenAIHandler(BaseHTTPRequestHandler):
+    """/v1/completions, /v1/chat/completions and /v1/models in the OpenAI wire format"""
+
+    schedulers = {}
+    default_model = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, error_type="invalid_request_error"):
+        self.send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": None}})
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def send_event(self, payload):
+        self.wfile.write(b"data: " + (payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")) + b"\n\n")
+        self.wfile.flush()
+
+    def scheduler(self, body):
+        # OpenAI model names fall back to the default model
+        name = body.get("model") or body.get("engine")
+        return self.schedulers.get(name) or self.schedulers[self.default_model]
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            return self.send_error_json(404, "Unknown path " + self.path)
+        self.send_json(200, {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "local"} for name in self.schedulers]})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self.send_error_json(400, "Request body is not valid json")
+
+        path = self.path.rstrip("/")
+        try:
+            if path == "/v1/completions":
+                self.completions(body)
+            elif path == "/v1/chat/completions":
+                self.chat_completions(body)
+            else:
+                self.send_error_json(404, "Unknown path " + self.path)
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_error_json(400, "Invalid request: {}".format(e))
+        except RuntimeError as e:
+            self.send_error_json(500, str(e), "server_error")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def wait(self, job):
+        status, value = job.out.get()
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+    def completions(self, body):
+        scheduler = self.scheduler(body)
+        name = body.get("model") or body.get("engine") or scheduler.model
+        prompts = body.get("prompt", "")
+        prompts = [prompts] if isinstance(prompts, str) else prompts
+        if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) for p in prompts):
+            raise ValueError("prompt must be a string or a non-empty list of strings")
+        params = completion_params(body)
+        params["echo"] = bool(body.get("echo"))
+        created = int(time.time())
+        request_id = "cmpl-" + uuid.uuid4().hex
+
+        if body.get("stream"):
+            self.start_events()
+            for index, prompt in enumerate(prompts):
+                job = scheduler.submit(prompt, params, stream=True)
+                while True:
+                    status, value = job.out.get()
+                    if status == "end":
+                        break
+                    if status == "error":
+                        value = {"choices": [{"text": "", "finish_reason": "error"}]}
+                    choice = dict(value["choices"][0], index=index)
+                    self.send_event({"id": request_id, "object": "text_completion", "created": created, "model": name, "choices": [choice]})
+                    if status == "error":
+                        break
+            return self.send_event(b"[DONE]")
+
+        # Every prompt of the request is queued at once, free slots take them in parallel
+        jobs = [scheduler.submit(prompt, params) for prompt in prompts]
+        responses = [self.wait(job) for job in jobs]
+        self.send_json(200, {
+            "id": request_id,
+            "object": "text_completion",
+            "created": created,
+            "model": name,
+            "choices": [dict(r["choices"][0], index=i) for i, r in enumerate(responses)],
+            "usage": {key: sum(r["usage"][key] for r in responses) for key in ("prompt_tokens", "completion_tokens", "total_tokens")},
+        })
+
+    def chat_completions(self, body):
+        scheduler = self.scheduler(body)
+        name = body.get("model") or scheduler.model
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages or not all(isinstance(m, dict) and isinstance(m.get("role"), str) for m in messages):
+            raise ValueError("messages must be a non-empty list of objects with a role")
+        # Requests with `tools` are answered with tool_calls, the older `functions` with a function_call
+        use_tools = bool(body.get("tools"))
+        functions = [t["function"] for t in body["tools"] if t.get("type") == "function"] if use_tools else body.get("functions") or []
+        function_call = body.get("tool_choice" if use_tools else "function_call", "auto" if functions else "none")
+        if isinstance(function_call, dict) and "function" in function_call:
+            function_call = function_call["function"]
+        params = completion_params(body, max_tokens=512)
+        params["stop"] = params["stop"] + CHAT_STOP
+        if isinstance(function_call, dict) and functions:
+            params["grammar"] = function_grammar(function_call["name"])
+        prompt = chat_prompt(messages, functions if function_call != "none" else None)
+        created = int(time.time())
+        request_id = "chatcmpl-" + uuid.uuid4().hex
+
+        if body.get("stream") and not functions:
+            self.start_events()
+            job = scheduler.submit(prompt, params, stream=True)
+            self.send_event({"id": request_id, "object": "chat.completion.chunk", "created": created, "model": name,
+                             "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]})
+            while True:
+                status, value = job.out.get()
+                if status == "end":
+                    break
+                choice = value["choices"][0] if status == "chunk" else {"text": "", "finish_reason": "error"}
+                self.send_event({"id": request_id, "object": "chat.completion.chunk", "created": created, "model": name,
+                                 "choices": [{"index": 0, "delta": {"content": choice["text"]} if choice["text"] else {}, "finish_reason": choice["finish_reason"]}]})
+                if status == "error":
+                    break
+            return self.send_event(b"[DONE]")
+
+        response = self.wait(scheduler.submit(prompt, params))
+        choice = response["choices"][0]
+        text = choice["text"].strip()
+        message = {"role": "assistant", "content": text}
+        finish_reason = choice["finish_reason"]
+        call = parse_function_call(text, functions) if function_call != "none" and functions else None
+        if call is not None and use_tools:
+            message = {"role": "assistant", "content": None, "tool_calls": [{"id": "call_" + uuid.uuid4().hex[:24], "type": "function", "function": call}]}
+            finish_reason = "tool_calls"
+        elif call is not None:
+            message = {"role": "assistant", "content": None, "function_call": call}
+            finish_reason = "function_call"
+
+        payload = {
+            "id": request_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": name,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": response["usage"],
+        }
+        if body.get("stream"):
+            # Function calls are only known once the answer is complete, send it as a single chunk
+            self.start_events()
+            delta = dict(message, tool_calls=[dict(t, index=i) for i, t in enumerate(message["tool_calls"])]) if "tool_calls" in message else message
+            self.send_event({"id": request_id, "object": "chat.completion.chunk", "created": created, "model": name,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]})
+            return self.send_event(b"[DONE]")
+        self.send_json(200, payload)
+
+def serve(models, host="localhost", port=8000, slots=1, **overrides):
+    """Serve models behind an OpenAI-compatible API, the first model answers requests for unknown model names
+
+    Args:
+        models (list): Registry keys or gguf paths
+        host (str, optional): Address to bind. Defaults to "localhost".
+        port (int, optional): Port to bind. Defaults to 8000.
+        slots (int, optional): llama.cpp contexts per model. Defaults to 1.
+        **overrides: Llama arguments overriding the registry defaults (n_ctx, n_threads, ...)
+    """
+    for model in models:
+        OpenAIHandler.schedulers[model] = Scheduler(model, slots=slots, **overrides)
+        print("Loaded", model_path(model), "x", slots, file=sys.stderr)
+    OpenAIHandler.default_model = models[0]
+
+    server = ThreadingHTTPServer((host, port), OpenAIHandler)
+    server.daemon_threads = True
+    print("Serving on http://{}:{}/v1, set OPENAI_API_BASE to use it from the openai scripts".format(host, port), file=sys.stderr)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible API over llama-cpp")
+    parser.add_argument("models", nargs="+", help="registry keys ({}) or gguf paths".format(", ".join(MODELS)))
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--slots", type=int, default=1, help="llama.cpp contexts per model, requests run in parallel across them")
+    parser.add_argument("--n-ctx", type=int, default=None)
+    args = parser.parse_args()
+
+    serve(args.models, args.host, args.port, args.slots, **({"n_ctx": args.n_ctx} if args.n_ctx else {}))
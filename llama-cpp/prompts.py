@@ -1,17 +1,103 @@
-import re, json
+import re, json, time
 from dataclasses import dataclass
 
-from utils import count_tokens, limit_tokens, extract_json_category
+from utils import truncate_tokens, extract_json_category
+from jsonlog import get_logger
 
 @dataclass
 class MessageDict():
     system_prompt: str
     user_msg: str
 
+class CompiledTemplate():
+    """Template compiled once into static segments and the slots left to fill per row.
+        Static segments are also pre-tokenized once per model, so only the slot values are tokenized per row.
+    """
+
+    def __init__(self, template, **static):
+        """
+        Args:
+            template (str): Template with {slot} placeholders
+            **static: Values of the slots that never change (system prompt, one-shot samples)
+        """
+        parts = re.split("{(.*?)}", template)
+        self.segments, self.slots = [parts[0]], []
+        for slot, text in zip(parts[1::2], parts[2::2]):
+            if slot in static:
+                self.segments[-1] += str(static[slot]) + text
+            else:
+                self.slots.append(slot)
+                self.segments.append(text)
+        self.tokens = {}
+
+    def render(self, **values):
+        """Fill the slots
+
+        Returns:
+            str: The rendered prompt
+        """
+        return self.segments[0] + "".join(str(values[slot]) + segment for slot, segment in zip(self.slots, self.segments[1:]))
+
+    def tokenize(self, llm):
+        """Pre-tokenized static segments for a model, None if piecewise tokenization does not match the full prompt
+
+        Args:
+            llm (Llama): Loaded llama.cpp model
+
+        Returns:
+            list: Token list of each static segment
+        """
+        if llm.model_path not in self.tokens:
+            segments = [llm.tokenize(self.segments[0].encode("utf-8"))] + [tokenize_piece(llm, segment) for segment in self.segments[1:]]
+
+            # Tokenizers can merge across segment boundaries, so check on a sample row before trusting the pieces
+            probe = {slot: "a great product and convenient shipment" for slot in self.slots}
+            self.tokens[llm.model_path] = segments
+            if self.render_tokens(llm, **probe) != llm.tokenize(self.render(**probe).encode("utf-8")):
+                self.tokens[llm.model_path] = None
+        return self.tokens[llm.model_path]
+
+    def render_tokens(self, llm, **values):
+        """Fill the slots at token level, only the slot values are tokenized
+
+        Args:
+            llm (Llama): Loaded llama.cpp model
+
+        Returns:
+            list: Prompt tokens, or None when the template can't be pre-tokenized for this model
+        """
+        segments = self.tokenize(llm)
+        if segments is None:
+            return None
+
+        tokens = list(segments[0])
+        for slot, segment in zip(self.slots, segments[1:]):
+            tokens += tokenize_piece(llm, str(values[slot])) + segment
+        return tokens
+
+def tokenize_piece(llm, text):
+    """Tokenize text that continues a prompt, without the bos token and leading space llama.cpp adds to a new text
+
+    Args:
+        llm (Llama): Loaded llama.cpp model
+        text (str): Text to tokenize
+
+    Returns:
+        list: Tokens of the text
+    """
+    # A newline is never merged with what follows, so tokenize after one and drop it
+    marker = llm.tokenize(b"\n", add_bos=False)
+    return llm.tokenize(b"\n" + text.encode("utf-8"), add_bos=False)[len(marker):]
+
 @dataclass
 class PromptConfig():
     msg: str
     prompt = response = duration = log_path = ""
+    prefix = "" # static part of the prompt, everything before the user message
+    echo = True # the response text starts with the prompt
+    row_id = None # stable id of the row, logged with the response
+    use_grammar = False # decode under the json grammar of the expected answer
+    categories = subcategories = None # allowed CATEGORY values and first SUB-CATEGORY values, None for free labels
 
     def __post_init__(self):
         self.prompt = self.msg
@@ -25,6 +111,18 @@ class PromptConfig():
     def set_log_path(self, log_path):
         self.log_path = log_path
 
+    def set_echo(self, echo):
+        self.echo = echo
+
+    def set_row_id(self, row_id):
+        self.row_id = row_id
+
+    def grammar(self):
+        return category_grammar(self.categories, self.subcategories)
+
+    def prompt_tokens(self, llm):
+        return None
+
 class LlamaConfig(PromptConfig):
 # LLAMA2 CHAT GGUF
 
@@ -48,11 +146,34 @@ class LlamaConfig(PromptConfig):
             user_msg=self.msg,
         )
         self.prompt = re.sub("{(.*?)}",lambda m:str(getattr(msg_items, m.group(1))), self.template)
+        self.prefix = re.sub("{(.*?)}",lambda m:str(getattr(msg_items, m.group(1))), self.template.split("{user_msg}")[0])
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
         self.init_prompt()
 
+def category_grammar(categories=None, subcategories=None, max_subcategories=3, max_label_chars=40):
+    """Compile the expected { "CATEGORY": ..., "SUB-CATEGORY": [...]} answer into a llama.cpp GBNF grammar
+
+    Args:
+        categories (list, optional): Allowed CATEGORY values. Defaults to None (any short label).
+        subcategories (list, optional): Allowed values of the first SUB-CATEGORY item. Defaults to None (any short label).
+        max_subcategories (int, optional): Maximum number of SUB-CATEGORY items. Defaults to 3.
+        max_label_chars (int, optional): Maximum length of a free label, so a label cannot run to max_tokens. Defaults to 40.
+
+    Returns:
+        str: The GBNF grammar
+    """
+    def enum(values):
+        return " | ".join('"\\"{}\\""'.format(value) for value in values) if values else "label"
+
+    return "\n".join([
+        'root ::= "{ \\"CATEGORY\\": " category ", \\"SUB-CATEGORY\\": [" first' + ' (", " label)?' * (max_subcategories - 1) + ' "]}"',
+        'category ::= ' + enum(categories),
+        'first ::= ' + enum(subcategories),
+        'label ::= "\\"" [A-Za-z0-9 &/-]{1,' + str(max_label_chars) + '} "\\""',
+    ])
+
 # region CLASSIFICATION
 CLASSIFICATION_SYSTEM_PROMPT = """You are an expert in going through customer messages and categorize them for an ecommerce website.
 Your responsibility is to follow the steps provided without any preamble or further questions and provide the best categories you can come up with.
@@ -67,30 +188,46 @@ Steps to follow:
 """
 # 4. Come up with generic categories, a main category and set of sub-categories that best fit the INPUT message (i.e., feedback, review, complain, inquiry, etc.). 
 
-@dataclass
-class OneshotMessageDict(MessageDict):
-    sample_user_1: str
-    sample_response_1: str
+# Compiled templates, one per config class
+_compiled_templates = {}
 
 @dataclass
-class ClassificationConfig(PromptConfig):
+class OneshotConfig(PromptConfig):
 
     token_limit: int
-    system_prompt = CLASSIFICATION_SYSTEM_PROMPT
-    template = ""
+    use_grammar: bool = False
+    system_prompt = sample_user_1 = sample_response_1 = template = ""
 
     def __post_init__(self):
-        adjusted_msg = limit_tokens(self.msg, self.token_limit) if count_tokens(self.msg) > self.token_limit else self.msg
-        print("Original Token count:", count_tokens(self.msg),"Limited Token count:", count_tokens(adjusted_msg))
+        adjusted_msg, original_count, limited_count = truncate_tokens(self.msg, self.token_limit)
+        print("Original Token count:", original_count,"Limited Token count:", limited_count)
         self.msg = adjusted_msg
 
-        msg_items = OneshotMessageDict(
-            system_prompt=self.system_prompt,
-            user_msg=self.msg,
-            sample_user_1="I subscribe to this monthly but just got an email stating that it's changing from 17 oz. to 16.9 oz. - ",
-            sample_response_1='{ "CATEGORY": "Complaint", "SUB-CATEGORY": ["Pricing"]}',
-        )
-        self.prompt = re.sub("{(.*?)}",lambda m:str(getattr(msg_items, m.group(1))), self.template)
+        template = self.compiled_template()
+        self.prompt = template.render(user_msg=self.msg)
+        self.prefix = template.segments[0]
+
+    @classmethod
+    def compiled_template(cls):
+        if cls not in _compiled_templates:
+            _compiled_templates[cls] = CompiledTemplate(
+                cls.template,
+                system_prompt=cls.system_prompt,
+                sample_user_1=cls.sample_user_1,
+                sample_response_1=cls.sample_response_1,
+            )
+        return _compiled_templates[cls]
+
+    def prompt_tokens(self, llm):
+        return self.compiled_template().render_tokens(llm, user_msg=self.msg)
+
+@dataclass
+class ClassificationConfig(OneshotConfig):
+
+    system_prompt = CLASSIFICATION_SYSTEM_PROMPT
+    sample_user_1 = "I subscribe to this monthly but just got an email stating that it's changing from 17 oz. to 16.9 oz. - "
+    sample_response_1 = '{ "CATEGORY": "Complaint", "SUB-CATEGORY": ["Pricing"]}'
+    categories = ["Review","Inquiry","Feedback","Cancellation","Complaint","Exchange","Return","Request","Notification"]
 
 @dataclass
 class LlamaClassificationConfig(ClassificationConfig):
@@ -135,9 +272,6 @@ class WizClassificationConfig(ClassificationConfig):
 ``` """
 
 def parseCategoryResponse(prompt_config):
-    with open(prompt_config.log_path, "a") as file: 
-        json.dump(prompt_config.response, file, indent=4)
-
     # Parse response
     response_args = prompt_config.response["choices"][0]["text"]
     print("RAW RESPONSE")
@@ -146,12 +280,16 @@ def parseCategoryResponse(prompt_config):
     print("="*50)
     
     # Strip the prompt and get only llm response
-    first_index = response_args.find(prompt_config.cutoff) # find the first instance of cutoff
-    second_index = response_args.find(prompt_config.cutoff, first_index+len(prompt_config.cutoff)) # then find thne next instance
-    response_args = response_args[second_index + len(prompt_config.cutoff):]
+    if prompt_config.echo:
+        first_index = response_args.find(prompt_config.cutoff) # find the first instance of cutoff
+        second_index = response_args.find(prompt_config.cutoff, first_index+len(prompt_config.cutoff)) # then find thne next instance
+        response_args = response_args[second_index + len(prompt_config.cutoff):]
 
-    response_json = extract_json_category(response_args)
-    if len(response_json) > 1: # We typically always want to skip the example json
+    if prompt_config.use_grammar and not prompt_config.echo and response_args.strip().endswith("]}"):
+        response_json = [response_args.strip()] # valid by construction, no need to search for it
+    else:
+        response_json = extract_json_category(response_args)
+    if len(response_json) > 1 and prompt_config.echo: # We typically always want to skip the example json
         response_args = response_json[1]
     elif len(response_json) <= 0: # Return empty json string if nothing is found
         response_args ='{ "CATEGORY": "None", "SUB-CATEGORY": ["None"]}'
@@ -173,6 +311,14 @@ def parseCategoryResponse(prompt_config):
         , "completion_cost":prompt_config.response["usage"]["completion_tokens"]
         , "duration":round(prompt_config.duration, 1)
     }
+
+    # Written in the background, the logged items are enough to rebuild the csv (see jsonlog.replay)
+    get_logger(prompt_config.log_path).log({
+        "row_id":prompt_config.row_id
+        , "time":time.time()
+        , "response":prompt_config.response
+        , "items":response_items
+    })
     return response_items
 # endregion
 
@@ -190,23 +336,11 @@ Steps to follow:
 """
 
 @dataclass
-class PurchaseReasonConfig(PromptConfig):
-    token_limit: int
-    system_prompt = PURCHASE_REASON_SYSTEM_PROMPT
-    template = ""
+class PurchaseReasonConfig(OneshotConfig):
 
-    def __post_init__(self):
-        adjusted_msg = limit_tokens(self.msg, self.token_limit) if count_tokens(self.msg) > self.token_limit else self.msg
-        print("Original Token count:", count_tokens(self.msg),"Limited Token count:", count_tokens(adjusted_msg))
-        self.msg = adjusted_msg
-
-        msg_items = OneshotMessageDict(
-            system_prompt=self.system_prompt,
-            user_msg=self.msg,
-            sample_user_1="a great product and convenient shipment",
-            sample_response_1='{ "CATEGORY": "Quality", "SUB-CATEGORY": ["Convenience"]}',
-        )
-        self.prompt = re.sub("{(.*?)}",lambda m:str(getattr(msg_items, m.group(1))), self.template)
+    system_prompt = PURCHASE_REASON_SYSTEM_PROMPT
+    sample_user_1 = "a great product and convenient shipment"
+    sample_response_1 = '{ "CATEGORY": "Quality", "SUB-CATEGORY": ["Convenience"]}'
 
 @dataclass
 class LlamaPurchaseReasonConfig(PurchaseReasonConfig):
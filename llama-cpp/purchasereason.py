@@ -1,24 +1,23 @@
 import pandas as pd
-import os, pytz, time
+import os, pytz
 
 from datetime import datetime
-from llama_cpp import Llama
 
-from prompts import LlamaPurchaseReasonConfig as LLMConfig, parseCategoryResponse
-# from prompts import WizardLMPurchaseReasonConfig as LLMConfig, parseCategoryResponse
-from utils import write_csv_line
+from prompts import LlamaPurchaseReasonConfig as LLMConfig
+# from prompts import WizardLMPurchaseReasonConfig as LLMConfig
+from writer import ResultWriter
+from utils import precompute_tokens
+from runner import run_prompt, PrefixCache
+from cache import CompletionCache
+from batch import run_batch
+from models import get_model
 
 
 # ===============
 # EDIT HERE
 # ===============
-MODELS = {
-    "LLAMA13B_Q4":"llama-2-13b-chat.Q4_K_M",
-    "LLAMA13B_Q5":"llama-2-13b-chat.Q5_K_M",
-    "LLAMA7B_Q4":"llama-2-7b-chat.Q4_K_M",
-    "LLAMA7B_Q4":"llama-2-7b-chat.Q5_K_M",
-    "WIZLM_Q5":"Wizard-Vicuna-13B-Uncensored.Q5_K_M"
-}
+MODEL = "LLAMA13B_Q5" # registry key from models.py, `python models.py list`
+MODEL_SERVER = None # e.g. ("localhost", 6060) to attach to models kept loaded by `python models.py serve LLAMA13B_Q5`
 
 DATA_FILE = "../data/fine_food_reviews_1k.csv"
 OUT_FILE = "./outdata_purchasereason.csv"
@@ -26,62 +25,77 @@ TEXT_COLUMN = "Text"
 MAX_TOKENS = 200
 SAMPLE_SIZE = 100
 PROJECT_NAME = "amazonfoodreview"
+CACHE_FILE = "./cache/completions.sqlite" # temperature=0 completions are reused across runs
+SAMPLE_SEED = 42 # fixed sample so a resumed run picks up the same rows
+STREAM = False # stream without echo and stop as soon as the json answer is complete
+GRAMMAR = False # decode under a json grammar of the expected answer, valid by construction
+WORKERS = 1 # worker processes, each loading its own model (1 to run in this process)
 
-MODEL_PATH = "/home/catsmile/models/{model}.gguf".format(model=MODELS["LLAMA13B_Q5"])
-
-# ===============
-# READ DATA
-# ===============
-# DF = pd.read_csv(DATA_FILE, index_col=False, encoding="shift_jis", usecols=["INQUIRY_ID", "ITEM_NAME", "MSG"])
-DF = pd.read_csv(DATA_FILE, index_col=False)
-print(DF.head(3))
-print("="*50)
-
-
-# ===============
-# INIT VARIOUS
-# ===============
-LOG_DT = str(datetime.now().astimezone(pytz.timezone('Asia/Tokyo')).strftime('%y%m%d_%H%M%S_'))
-if not os.path.exists("./logs/"): os.mkdir("./logs/")
-
-# n_gpu_layers: 0 for no GPU, -1 to offload everything to GPU
-llm = Llama(model_path=MODEL_PATH, verbose=False, n_ctx=700, n_threads=5, n_gpu_layers=-1)
+# Set by main(), chat_request runs with them
+writer = cache = llm = prefix_cache = LOG_PATH = None
 
 
 # ===============
 # CHAT FUNCTION
 # ===============
-def chat_request(prompt_config, outfile=OUT_FILE):
-
-    # Call API for initial thought prompting
-    start_time = time.time()
-    response = llm(
-        prompt_config.prompt,
-        temperature=0,
-        max_tokens=100, 
-        stop=prompt_config.stop, 
-        echo=True,
-    )
-    end_time = time.time()
-    duration = end_time - start_time
-
-    prompt_config.set_response(response)
-    prompt_config.set_duration(duration)
-    prompt_config.set_log_path("./logs/"+LOG_DT+"_"+PROJECT_NAME+"_raw.md")
-
-    response_parsed = parseCategoryResponse(prompt_config)
-    write_csv_line(outfile, response_parsed)
+def chat_request(prompt_config, row_id=None):
+
+    response_parsed = run_prompt(llm, prompt_config, LOG_PATH, prefix_cache=prefix_cache, cache=cache, stream=STREAM, row_id=row_id)
+    writer.write({"row_id":row_id, **response_parsed})
 
     return response_parsed["category"], response_parsed["subcategory"]
 
 
-# ===============
-# TEST on dataframe
-# ===============
-test_df = DF.sample(SAMPLE_SIZE) if SAMPLE_SIZE > 0 else DF.copy()
-test_df[['llama-cat','llama-subcat']] = test_df.apply(lambda x: chat_request(LLMConfig(x[TEXT_COLUMN], MAX_TOKENS)), axis=1, result_type='expand')
+def main():
+    global writer, cache, llm, prefix_cache, LOG_PATH
+
+    # ===============
+    # READ DATA
+    # ===============
+    # DF = pd.read_csv(DATA_FILE, index_col=False, encoding="shift_jis", usecols=["INQUIRY_ID", "ITEM_NAME", "MSG"])
+    DF = pd.read_csv(DATA_FILE, index_col=False)
+    print(DF.head(3))
+    print("="*50)
+
+    # ===============
+    # INIT VARIOUS
+    # ===============
+    LOG_DT = str(datetime.now().astimezone(pytz.timezone('Asia/Tokyo')).strftime('%y%m%d_%H%M%S_'))
+    if not os.path.exists("./logs/"): os.mkdir("./logs/")
+    LOG_PATH = "./logs/"+LOG_DT+"_"+PROJECT_NAME+"_raw.jsonl"
+    writer = ResultWriter(OUT_FILE) # rows already in OUT_FILE are skipped on restart
+    cache = CompletionCache(CACHE_FILE)
+
+    # n_ctx, n_threads and n_gpu_layers come from the registry entry of MODEL
+    llm = None if WORKERS > 1 else get_model(MODEL, server=MODEL_SERVER)
+    prefix_cache = PrefixCache(llm) if llm is not None and MODEL_SERVER is None else None # evaluate the static one-shot prefix only once (a server keeps its own state)
+
+    # ===============
+    # TEST on dataframe
+    # ===============
+    test_df = DF.sample(SAMPLE_SIZE, random_state=SAMPLE_SEED) if SAMPLE_SIZE > 0 else DF.copy()
+    test_df = test_df[~test_df.index.astype(str).isin(writer.done_keys())].copy()
+    print("Rows left to classify:", len(test_df))
+    precompute_tokens(test_df[TEXT_COLUMN], MAX_TOKENS) # one batched encode for the whole column
+    if len(test_df) == 0:
+        pass
+    elif WORKERS > 1:
+        results = run_batch(test_df[TEXT_COLUMN], LLMConfig, MODEL, MAX_TOKENS, LOG_PATH, workers=WORKERS, stream=STREAM, use_grammar=GRAMMAR, cache_path=CACHE_FILE, row_ids=test_df.index, writer=writer)
+        test_df[['llama-cat','llama-subcat']] = [(r["category"], r["subcategory"]) for r in results]
+    else:
+        test_df[['llama-cat','llama-subcat']] = test_df.apply(lambda x: chat_request(LLMConfig(x[TEXT_COLUMN], MAX_TOKENS, use_grammar=GRAMMAR), row_id=x.name), axis=1, result_type='expand')
+    writer.close()
+    if WORKERS == 1:
+        # With workers the hits happen in their own caches, the one of this process stays empty
+        print("Completion cache:", cache.stats())
+
 
 # ===============
 # TEST 1 line
 # ===============
-# print(chat_request(LLMConfig("This has been the best tasting Stevia I have tried.  I also think this is a better value than some of the others.  I really like not having to open all the packets when I make a gallon of Tea.", MAX_TOKENS)))
\ No newline at end of file
+# print(chat_request(LLMConfig("This has been the best tasting Stevia I have tried.  I also think this is a better value than some of the others.  I really like not having to open all the packets when I make a gallon of Tea.", MAX_TOKENS)))
+
+
+# Worker processes import this file, under spawn (macOS, Windows) main() must only run in the parent
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import time
+
+from prompts import parseCategoryResponse
+from utils import JsonCategoryStream
+
+class PrefixCache():
+    """Evaluates the static prompt prefix once and keeps the llama.cpp state to restore it for each row.
+        Llama only runs prompt-eval on the tokens that do not match its current state,
+        so restoring the prefix state leaves just the per-row suffix to be evaluated.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.tokens = {}
+        self.states = {}
+
+    def restore(self, prefix):
+        """Put the model in the state right after `prefix` was evaluated
+
+        Args:
+            prefix (str): Static part of the prompt
+        """
+        if not prefix:
+            return
+
+        if prefix not in self.states:
+            tokens = self.llm.tokenize(prefix.encode("utf-8"))
+            self.llm.reset()
+            self.llm.eval(tokens)
+            self.tokens[prefix] = tokens
+            self.states[prefix] = self.llm.save_state()
+            return
+
+        # Skip the copy when the model still holds the prefix from the previous row
+        tokens = self.tokens[prefix]
+        if self.llm.n_tokens >= len(tokens) and list(self.llm.input_ids[:len(tokens)]) == tokens:
+            return
+        self.llm.load_state(self.states[prefix])
+
+# Parsed grammars, keyed on the GBNF text
+_grammars = {}
+
+def compile_grammar(grammar):
+    """Parse a GBNF grammar once and reuse it for every row
+
+    Args:
+        grammar (str): GBNF grammar text
+
+    Returns:
+        LlamaGrammar: The parsed grammar
+    """
+    from llama_cpp import LlamaGrammar
+
+    if grammar not in _grammars:
+        _grammars[grammar] = LlamaGrammar.from_string(grammar, verbose=False)
+    return _grammars[grammar]
+
+def stream_prompt(llm, prompt, **params):
+    """Stream a completion without echo and stop as soon as the first category json is complete
+
+    Args:
+        llm (Llama): Loaded llama.cpp model
+        prompt (str or list): Rendered prompt, or its tokens
+        **params: Generation arguments (temperature, max_tokens, stop, ...)
+
+    Returns:
+        dict: Response in the same shape as a non-streamed Llama completion
+    """
+    scanner = JsonCategoryStream()
+    text = ""
+    completion_tokens = 0
+    finish_reason = "length"
+    for chunk in llm(prompt, stream=True, echo=False, **params):
+        choice = chunk["choices"][0]
+        text += choice["text"]
+        completion_tokens += 1
+        if scanner.feed(choice["text"]) is not None:
+            finish_reason = "json"
+            break
+        if choice.get("finish_reason"):
+            finish_reason = choice["finish_reason"]
+
+    prompt_tokens = len(prompt) if isinstance(prompt, list) else len(llm.tokenize(prompt.encode("utf-8")))
+    return {
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+def run_prompt(llm, prompt_config, log_path, max_tokens=100, prefix_cache=None, cache=None, stream=False, row_id=None):
+    """Send a prompt config to the model and parse the category response
+
+    Args:
+        llm (Llama or RemoteLlama): Loaded llama.cpp model, or a client of a model server
+        prompt_config (PromptConfig): Prompt config holding the rendered prompt and stop words
+        log_path (str): Path of the raw response log
+        max_tokens (int, optional): Maximum tokens to generate. Defaults to 100.
+        prefix_cache (PrefixCache, optional): Cache of the evaluated prompt prefix for `llm`. Defaults to None.
+        cache (CompletionCache, optional): Persistent cache of deterministic completions. Defaults to None.
+        stream (bool, optional): Stream without echo and stop once the json answer is complete. Defaults to False.
+        row_id (optional): Stable id of the row, logged with the response. Defaults to None.
+
+    Returns:
+        dict: Parsed response items (text, category, subcategory, costs and duration)
+    """
+    params = dict(
+        temperature=0,
+        max_tokens=max_tokens,
+        stop=prompt_config.stop,
+    )
+
+    grammar = prompt_config.grammar() if prompt_config.use_grammar else None
+
+    start_time = time.time()
+    response = key = None
+    if cache is not None and cache.cacheable(params):
+        key = cache.make_key(llm.model_path, prompt_config.prompt, stream=stream, grammar=grammar, **params)
+        response = cache.get(key)
+
+    if response is None:
+        if prefix_cache is not None:
+            prefix_cache.restore(prompt_config.prefix)
+        if grammar:
+            # A model server parses the GBNF text on its side
+            call_params = dict(params, grammar=grammar if getattr(llm, "remote", False) else compile_grammar(grammar))
+        else:
+            call_params = params
+        # Pre-tokenized static segments, only the user message is tokenized here
+        prompt = prompt_config.prompt_tokens(llm) or prompt_config.prompt
+        if stream:
+            response = stream_prompt(llm, prompt, **call_params)
+        else:
+            response = llm(prompt, echo=True, **call_params)
+        if key is not None:
+            cache.put(key, response)
+    end_time = time.time()
+    duration = end_time - start_time
+
+    prompt_config.set_response(response)
+    prompt_config.set_duration(duration)
+    prompt_config.set_log_path(log_path)
+    prompt_config.set_echo(not stream)
+    prompt_config.set_row_id(row_id)
+
+    return parseCategoryResponse(prompt_config)
@@ -1,42 +1,144 @@
-import os, json, time
-
-from llama_cpp import Llama
-
-llama = Llama(model_path="/home/catsmile/models/llama-2-7b-chat.Q5_K_M.gguf", verbose=False, n_ctx=100, n_threads=1, n_gpu_layers=-1)
-
-def get_reply(prompt):
-    start_time = time.time()
-    response = llama.create_completion(
-        f"""{prompt}""", 
-        max_tokens=100, 
-        stop=["</s>"], 
-        echo=False
-    )
-    end_time = time.time()
-    duration = end_time - start_time
-        
-    print(response["choices"][0]["text"])
-    print("Time-taken: ", duration)
-
-    # dump response
-    response = {"prompt":prompt} | response
-    response["duration"] = round(duration,1)
-    with open("./log.log", "a") as file: 
-        json.dump(response, file, indent=4)
-        file.write("\n"+"="*50+"\n")
+import os, time
+
+from jsonlog import get_logger
+from models import get_model
+from prompts import tokenize_piece
+
+MODEL = "LLAMA7B_Q5" # registry key from models.py
+MODEL_SERVER = None # e.g. ("localhost", 6060) to attach to a running `python models.py serve`
+CONTEXT_SIZE = 2048 # tokens of conversation kept in the model, older turns are dropped past this
+MAX_REPLY_TOKENS = 256
+SYSTEM_PROMPT = "You are a very helpful assistant."
+STOP = ["</s>", "<s>", "[INST]", "[/INST]"]
+llama = None # loaded on first use, so the module can be imported (e.g. by bench.py) without a model
+
+def get_llama():
+    global llama
+    if llama is None:
+        llama = get_model(MODEL, server=MODEL_SERVER, n_ctx=CONTEXT_SIZE)
+    return llama
+
+class ChatSession():
+    """Multi-turn llama-2 chat on one model context.
+        The conversation is sent as tokens that extend the previous turn, so llama.cpp finds it in its KV cache
+        and only evaluates the new message. When the context is full the oldest turns are dropped,
+        down to half the context so the full re-evaluation this causes does not repeat on every turn.
+    """
+
+    def __init__(self, llm, system_prompt=SYSTEM_PROMPT, max_tokens=MAX_REPLY_TOKENS, n_ctx=None):
+        """
+        Args:
+            llm (Llama): Loaded llama.cpp model, not shared with other prompts while chatting
+            system_prompt (str, optional): System prompt of the first kept turn. Defaults to SYSTEM_PROMPT.
+            max_tokens (int, optional): Maximum tokens per reply. Defaults to MAX_REPLY_TOKENS.
+            n_ctx (int, optional): Context size. Defaults to the context of the model.
+        """
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.n_ctx = n_ctx or llm.n_ctx()
+        self.turns = [] # [message, reply, tokens] of each kept turn
+        self.stats = {}
+
+    def _turn_tokens(self, message, reply=None, first=False):
+        text = "[INST] {}{} [/INST]".format("<<SYS>>\n{}\n<</SYS>>\n\n".format(self.system_prompt) if first and self.system_prompt else "", message)
+        tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=True) if first else [self.llm.token_bos()] + tokenize_piece(self.llm, text)
+        if reply is not None:
+            tokens += tokenize_piece(self.llm, " " + reply) + [self.llm.token_eos()]
+        return tokens
+
+    def history_tokens(self):
+        return [token for turn in self.turns for token in turn[2]]
+
+    def _evict(self, needed):
+        """Drop the oldest turns until `needed` more tokens fit in the context"""
+        history = len(self.history_tokens())
+        if history + needed <= self.n_ctx:
+            return
+        target = min(self.n_ctx - needed, self.n_ctx // 2)
+        while self.turns and history > target:
+            history -= len(self.turns.pop(0)[2])
+        # The system prompt moves to the new first turn
+        if self.turns:
+            self.turns[0][2] = self._turn_tokens(*self.turns[0][:2], first=True)
+
+    def clear(self):
+        self.turns = []
+
+    def send(self, message):
+        """Stream the reply to a message
+
+        Args:
+            message (str): User message
+
+        Yields:
+            str: Pieces of the reply as they are decoded, timings are in `stats` once done
+        """
+        new = self._turn_tokens(message, first=not self.turns)
+        self._evict(len(new) + self.max_tokens)
+        if not self.turns:
+            new = self._turn_tokens(message, first=True)
+        if len(new) + self.max_tokens > self.n_ctx:
+            raise ValueError("Message is too long for the context ({} tokens)".format(len(new)))
+        prompt = self.history_tokens() + new
+
+        start_time = time.time()
+        first_time = None
+        reply = ""
+        completion_tokens = 0
+        for chunk in self.llm.create_completion(prompt, max_tokens=self.max_tokens, stop=STOP, stream=True):
+            text = chunk["choices"][0]["text"]
+            if first_time is None:
+                first_time = time.time()
+            completion_tokens += 1
+            reply += text
+            yield text
+        end_time = time.time()
+
+        reply = reply.strip()
+        self.turns.append([message, reply, self._turn_tokens(message, reply, first=not self.turns)])
+        first_time = first_time or end_time
+        self.stats = {
+            "prompt_tokens": len(prompt),
+            "completion_tokens": completion_tokens,
+            "context_tokens": len(self.history_tokens()),
+            "ttft": round(first_time - start_time, 3),
+            "tokens_per_s": round((completion_tokens - 1) / (end_time - first_time), 1) if completion_tokens > 1 and end_time > first_time else None,
+            "duration": round(end_time - start_time, 3),
+        }
+
+def get_reply(session, prompt):
+    reply = ""
+    for text in session.send(prompt):
+        reply += text
+        print(text, end="", flush=True)
+    print()
+    stats = session.stats
+    print("TTFT: {}s, {} tok/s, context {}/{}".format(stats["ttft"], stats["tokens_per_s"], stats["context_tokens"], session.n_ctx))
+
+    # dump response, written in the background
+    get_logger("./log.jsonl").log({"prompt":prompt, "reply":reply.strip(), **stats})
 
 def clear():
     os.system("cls" if os.name == "nt" else "clear")
 
 def main():
+    session = ChatSession(get_llama())
 
     while True:
         cli_prompt = input("\nYou: ")
 
         if cli_prompt == "exit":
             break
+        elif cli_prompt == "reset":
+            session.clear()
+            clear()
         else:
             print("LLM:", end="")
-            get_reply(cli_prompt) # or just call this line
+            try:
+                get_reply(session, cli_prompt) # or just call this line
+            except ValueError as e:
+                print(e)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
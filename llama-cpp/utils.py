@@ -1,4 +1,15 @@
-import os, re, tiktoken
+import os, re, importlib.util
+
+def _load_token_budget():
+    # Token budget is shared with the openai scripts. It is loaded from its file, not as includes.token_budget:
+    # the package __init__ loads .env through python-dotenv, which these scripts do not need
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "includes", "token_budget.py")
+    spec = importlib.util.spec_from_file_location("token_budget", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+get_budget = _load_token_budget().get_budget
 
 def write_csv_line(csv_path: str, values: dict):
     """Writes csv line(values) into csv (csv_path)
@@ -26,8 +37,7 @@ def count_tokens(text, model="gpt-4"):
     Returns:
         int: The token count of the text
     """
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return get_budget(model).count(text)
 
 def limit_tokens(text, max_tokens, model="gpt-4"):
     """Limits the text to meet max_token limit
@@ -40,9 +50,33 @@ def limit_tokens(text, max_tokens, model="gpt-4"):
     Returns:
         str: The text shrunk to the token limit
     """
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    return encoding.decode(tokens[:max_tokens])
+    return get_budget(model).truncate(text, max_tokens)[0]
+
+def truncate_tokens(text, max_tokens, model="gpt-4"):
+    """Limits the text to meet max_token limit and counts tokens before and after, encoding the text once
+
+    Args:
+        text (str): Text to shrink
+        max_tokens (int): Maximum token allowed for text
+        model (str, optional): Tokenizer model to use. Defaults to "gpt-4".
+
+    Returns:
+        tuple: (limited text, original token count, limited token count)
+    """
+    return get_budget(model).truncate(text, max_tokens)
+
+def precompute_tokens(texts, max_tokens, model="gpt-4"):
+    """Truncates and counts a whole column in one batched pass, so per-row truncate_tokens calls are lookups
+
+    Args:
+        texts (iterable): Texts to shrink, e.g. a DataFrame column
+        max_tokens (int): Maximum token allowed per text
+        model (str, optional): Tokenizer model to use. Defaults to "gpt-4".
+
+    Returns:
+        list: (limited text, original token count, limited token count) for each text
+    """
+    return get_budget(model).encode_batch(texts, max_tokens)
 
 def extract_json_category(text):
     """From a text, extract all the json string pair category and sub-category
@@ -66,4 +100,51 @@ def extract_json_category(text):
         json_string = f'{{ "CATEGORY": "{category}", "SUB-CATEGORY": ["{sub_category}"] }}'
         json_strings.append(json_string)
 
-    return json_strings
\ No newline at end of file
+    return json_strings
+
+class JsonCategoryStream():
+    """Incremental scanner over streamed text, recognises the first complete {"CATEGORY": ..., "SUB-CATEGORY": [...]} object.
+        Tracks brace depth and string state per character, so each streamed piece is only scanned once.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.start = -1
+        self.depth = 0
+        self.in_string = self.escaped = False
+        self.result = None
+
+    def feed(self, piece):
+        """Scan the next piece of streamed text
+
+        Args:
+            piece (str): Newly generated text
+
+        Returns:
+            str: The json string once the first category object is complete, otherwise None
+        """
+        if self.result is not None:
+            return self.result
+
+        offset = len(self.text)
+        self.text += piece
+        for i, char in enumerate(piece, start=offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.depth > 0:
+                self.in_string = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0 and extract_json_category(self.text[self.start:i+1]):
+                    self.result = self.text[self.start:i+1]
+                    return self.result
+        return None
@@ -0,0 +1,180 @@
+import os, io, csv, glob
+
+class ResultWriter():
+    """Buffered, resumable result writer keyed by a stable row id.
+        Rows are flushed in batches and fsync'ed at checkpoints, so a crashed run loses at most the unflushed batch.
+        Supports csv (a single file) and parquet (a directory of part files, requires pyarrow).
+        A parquet part stays open across flushes, one row group per batch, and is only complete once closed
+        every `part_rows` rows: a crash loses the rows of the open part, which a resumed run writes again.
+    """
+
+    def __init__(self, path, key="row_id", batch_size=10, checkpoint_every=50, format=None, part_rows=1000):
+        """
+        Args:
+            path (str): Output csv file, or output directory for parquet
+            key (str, optional): Column holding the row id. Defaults to "row_id".
+            batch_size (int, optional): Rows buffered before writing. Defaults to 10.
+            checkpoint_every (int, optional): Rows written between fsyncs. Defaults to 50.
+            format (str, optional): "csv" or "parquet". Defaults to the extension of `path`.
+            part_rows (int, optional): Rows per parquet part file. Defaults to 1000.
+        """
+        self.path = path
+        self.key = key
+        self.batch_size = batch_size
+        self.checkpoint_every = checkpoint_every
+        self.format = format or ("parquet" if path.endswith(".parquet") else "csv")
+        self.buffer = []
+        self.header = None
+        self.file = None
+        self.part_rows = part_rows
+        self.parquet_writer = None
+        self.part_size = 0
+        self.part = 0
+        self.since_checkpoint = 0
+        self.keys = self._load_keys()
+
+    # region RESUME
+    def _load_keys(self):
+        if self.format == "parquet":
+            return self._load_parquet_keys()
+        return self._load_csv_keys()
+
+    def _load_csv_keys(self):
+        if not os.path.exists(self.path):
+            return set()
+
+        with open(self.path, newline="") as file:
+            text = file.read()
+        rows = list(csv.reader(io.StringIO(text)))
+        if not rows:
+            return set()
+        self.header = rows[0]
+        # e.g. an output of a run before row ids, it is left as it is rather than rewritten or appended to
+        if self.key not in self.header:
+            raise ValueError("{} has no {} column to resume from, move it away or write to another file".format(self.path, self.key))
+
+        # Drop a record left incomplete by a crash mid-write, then rewrite the file without it
+        records = rows[1:] if text.endswith("\n") else rows[1:-1]
+        complete = [row for row in records if len(row) == len(self.header)]
+        if len(complete) != len(rows) - 1:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", newline="") as file:
+                writer = csv.writer(file, quoting=csv.QUOTE_ALL)
+                writer.writerows([self.header] + complete)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+        key_index = self.header.index(self.key)
+        return {row[key_index] for row in complete}
+
+    def _load_parquet_keys(self):
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.path, exist_ok=True)
+        # A part left open by a crash has no footer and cannot be read, its rows are written again
+        for tmp_path in glob.glob(os.path.join(self.path, "part-*.parquet.tmp")):
+            os.remove(tmp_path)
+        parts = sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+        self.part = len(parts)
+        keys = set()
+        for part in parts:
+            keys.update(str(k) for k in pq.read_table(part, columns=[self.key]).column(self.key).to_pylist())
+        return keys
+
+    def done_keys(self):
+        """Row ids already written by this or a previous run
+
+        Returns:
+            set: Row ids as strings
+        """
+        return set(self.keys)
+    # endregion
+
+    # region WRITE
+    def write(self, values):
+        """Buffer one result row, flushing when the batch is full
+
+        Args:
+            values (dict): keys are headers, values are values. Must contain the key column.
+        """
+        self.buffer.append(values)
+        self.keys.add(str(values[self.key]))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self, checkpoint=False):
+        """Write the buffered rows
+
+        Args:
+            checkpoint (bool, optional): Force an fsync after writing. Defaults to False.
+        """
+        if self.buffer:
+            if self.format == "parquet":
+                self._flush_parquet()
+            else:
+                self._flush_csv()
+            self.since_checkpoint += len(self.buffer)
+            self.buffer = []
+
+        if self.file and (checkpoint or self.since_checkpoint >= self.checkpoint_every):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.since_checkpoint = 0
+
+    def _flush_csv(self):
+        if self.file is None:
+            self.file = open(self.path, "a", newline="")
+        writer = csv.writer(self.file, quoting=csv.QUOTE_ALL)
+        if self.header is None:
+            self.header = list(self.buffer[0].keys())
+            writer.writerow(self.header)
+        writer.writerows([[row.get(h) for h in self.header] for row in self.buffer])
+        self.file.flush()
+
+    def _part_path(self):
+        return os.path.join(self.path, "part-{:05d}.parquet".format(self.part))
+
+    def _flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pylist(self.buffer)
+        if self.parquet_writer is not None and not table.schema.equals(self.parquet_writer.schema):
+            try:
+                table = table.cast(self.parquet_writer.schema)
+            except (pa.ArrowException, ValueError):
+                # Other columns or types (e.g. a column that was all null so far), they go to a new part
+                self._close_part()
+        if self.parquet_writer is None:
+            # Parts are written to a temp name and renamed when closed, so a part on disk is always complete
+            self.parquet_writer = pq.ParquetWriter(self._part_path() + ".tmp", table.schema)
+        self.parquet_writer.write_table(table)
+        self.part_size += len(self.buffer)
+        if self.part_size >= self.part_rows:
+            self._close_part()
+
+    def _close_part(self):
+        if self.parquet_writer is None:
+            return
+        self.parquet_writer.close()
+        with open(self._part_path() + ".tmp", "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(self._part_path() + ".tmp", self._part_path())
+        self.parquet_writer = None
+        self.part_size = 0
+        self.part += 1
+
+    def close(self):
+        self.flush(checkpoint=True)
+        self._close_part()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+    # endregion
@@ -0,0 +1,335 @@
+import os, json, time, argparse
+
+import numpy as np
+
+EXACT_THRESHOLD = 10000 # below this many vectors a search scans all of them
+
+# ===============
+# K-MEANS
+# ===============
+def normalize(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def nearest_centroid(data, centroids, block=8192):
+    """Closest centroid of each row by Euclidean distance, `block` rows at a time"""
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    return np.concatenate([np.argmax(data[i:i + block] @ centroids.T - half_norms, axis=1) for i in range(0, len(data), block)]
+                          or [np.zeros(0, np.int64)])
+
+def kmeans(data, k, n_iter=20, seed=0):
+    """Lloyd's k-means, empty clusters are restarted on random rows
+
+    Args:
+        data (np.array): Rows to cluster
+        k (int): Number of clusters
+        n_iter (int, optional): Iterations. Defaults to 20.
+        seed (int, optional): Seed of the initial centroids. Defaults to 0.
+
+    Returns:
+        np.ndarray: (k, dim) centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), k, replace=len(data) < k)].astype(np.float32)
+    for _ in range(n_iter):
+        assign = nearest_centroid(data, centroids)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        filled = np.flatnonzero(counts)
+        sums = np.add.reduceat(data[order], np.r_[0, np.cumsum(counts[filled])[:-1]], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = data[rng.choice(len(data), len(empty))]
+    return centroids
+
+# ===============
+# INDEX
+# ===============
+def top_k(scores, k):
+    """Positions of the `k` highest scores, highest first, without sorting the whole array"""
+    top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def _grow(array, size):
+    # Capacity doubles, so adding vectors one batch at a time stays linear overall
+    if size <= len(array):
+        return array
+    bigger = np.empty((max(size, 2 * len(array), 1024),) + array.shape[1:], array.dtype)
+    bigger[:len(array)] = array
+    return bigger
+
+class AnnIndex():
+    """Approximate nearest-neighbour index of vectors by cosine similarity, IVF-PQ in plain NumPy.
+        Vectors are grouped in `nlist` k-means lists, and their residual to the list centroid is product-quantized
+        to `m` bytes. A search scores the vectors of the `nprobe` closest lists from byte-code lookup tables,
+        then re-ranks the best `refine * k` with the exact vectors. Below `exact_threshold` vectors nothing is trained
+        and every vector is scanned.
+    """
+
+    def __init__(self, dim, nlist=None, m=None, nprobe=16, refine=16, exact_threshold=EXACT_THRESHOLD, seed=0):
+        """
+        Args:
+            dim (int): Dimension of the vectors
+            nlist (int, optional): Number of lists. Defaults to 4 * sqrt(vectors) when trained.
+            m (int, optional): Bytes per code, a divisor of `dim`. Defaults to the one closest to dim / 4.
+            nprobe (int, optional): Lists searched per query, more for a better recall. Defaults to 16.
+            refine (int, optional): Candidates re-ranked exactly, per result. Defaults to 16.
+            exact_threshold (int, optional): Vectors the index trains at, before that searches are exact. Defaults to EXACT_THRESHOLD.
+            seed (int, optional): Seed of the k-means. Defaults to 0.
+        """
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m or min((d for d in range(1, dim + 1) if dim % d == 0), key=lambda d: abs(d - dim / 4))
+        if dim % self.m:
+            raise ValueError("m must divide the dimension {}, got {}".format(dim, self.m))
+        self.nprobe = nprobe
+        self.refine = refine
+        self.exact_threshold = exact_threshold
+        self.seed = seed
+        self.size = 0
+        self.vectors = np.zeros((0, dim), np.float32) # normalized
+        self.ids = np.zeros(0, np.int64)
+        self.codes = np.zeros((0, self.m), np.uint8)
+        self.assign = np.zeros(0, np.int64)
+        self.centroids = None
+        self.codebooks = None # (m, 256, dim / m)
+        self.lists = []
+        self.trained_size = 0
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, vectors, ids=None):
+        """Add vectors, the index is trained once it holds `exact_threshold` of them
+
+        Args:
+            vectors (np.array): (n, dim) vectors
+            ids (np.array, optional): int64 id of each vector. Defaults to their position in the index.
+        """
+        vectors = normalize(vectors)
+        ids = np.arange(self.size, self.size + len(vectors)) if ids is None else np.asarray(ids, np.int64)
+        start, self.size = self.size, self.size + len(vectors)
+        for name, values in (("vectors", vectors), ("ids", ids)):
+            array = _grow(getattr(self, name), self.size)
+            array[start:self.size] = values
+            setattr(self, name, array)
+
+        # Trained again each time the index grows 4 times, which keeps the cost of adding linear overall
+        if self.size >= max(self.exact_threshold, 4 * self.trained_size):
+            self.train()
+        elif self.trained:
+            self._encode(start, self.size)
+
+    def train(self, sample=50000):
+        """Fit the lists and codebooks to (a sample of) the vectors added so far and encode all of them
+
+        Args:
+            sample (int, optional): Vectors the k-means runs on. Defaults to 50000.
+        """
+        vectors = self.vectors[:self.size]
+        rng = np.random.default_rng(self.seed)
+        data = vectors[np.sort(rng.choice(self.size, min(sample, self.size), replace=False))]
+        nlist = self.nlist or max(1, int(4 * np.sqrt(self.size)))
+        self.centroids = kmeans(data, min(nlist, len(data)), seed=self.seed)
+        residuals = data - self.centroids[nearest_centroid(data, self.centroids)]
+        sub = self.dim // self.m
+        self.codebooks = np.stack([kmeans(residuals[:, j * sub:(j + 1) * sub], min(256, len(data)), n_iter=10, seed=self.seed + j)
+                                   for j in range(self.m)])
+        self.lists = [np.zeros(0, np.int64) for _ in range(len(self.centroids))]
+        self.trained_size = self.size
+        self._encode(0, self.size)
+
+    def _encode(self, start, stop):
+        vectors = self.vectors[start:stop]
+        assign = nearest_centroid(vectors, self.centroids)
+        residuals = vectors - self.centroids[assign]
+        sub = self.dim // self.m
+        codes = np.stack([nearest_centroid(residuals[:, j * sub:(j + 1) * sub], self.codebooks[j]) for j in range(self.m)], axis=1)
+        self.codes = _grow(self.codes, stop)
+        self.codes[start:stop] = codes
+        self.assign = _grow(self.assign, stop)
+        self.assign[start:stop] = assign
+        order = np.argsort(assign, kind="stable")
+        touched, first = np.unique(assign[order], return_index=True)
+        for list_id, rows in zip(touched, np.split(order + start, first[1:])):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], rows])
+
+    def search_exact(self, queries, k=10, block=256):
+        """Scan every vector
+
+        Returns:
+            tuple: (similarities, ids), each (queries, k), padded with -inf and -1
+        """
+        queries = normalize(queries)
+        similarities = np.full((len(queries), k), -np.inf, np.float32)
+        ids = np.full((len(queries), k), -1, np.int64)
+        vectors = self.vectors[:self.size]
+        for start in range(0, len(queries), block):
+            scores = queries[start:start + block] @ vectors.T
+            for i, row in enumerate(scores, start):
+                top = top_k(row, k)
+                similarities[i, :len(top)] = row[top]
+                ids[i, :len(top)] = self.ids[top]
+        return similarities, ids
+
+    def search(self, queries, k=10, nprobe=None):
+        """Most similar vectors of each query
+
+        Args:
+            queries (np.array): (n, dim) queries, or one vector
+            k (int, optional): Results per query. Defaults to 10.
+            nprobe (int, optional): Lists searched. Defaults to self.nprobe.
+
+        Returns:
+            tuple: (cosine similarities, ids), each (queries, k) best first, padded with -inf and -1
+        """
+        if not self.trained:
+            return self.search_exact(queries, k)
+        queries = normalize(queries)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        sub = self.dim // self.m
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        # Similarity of each query part to each codebook entry, a code is scored by summing m of them
+        tables = np.einsum("qjs,jcs->qjc", queries.reshape(len(queries), self.m, sub), self.codebooks)
+        offsets = np.arange(self.m) * self.codebooks.shape[1]
+
+        similarities = np.full((len(queries), k), -np.inf, np.float32)
+        ids = np.full((len(queries), k), -1, np.int64)
+        for i, query in enumerate(queries):
+            rows = np.concatenate([self.lists[p] for p in probes[i]])
+            if len(rows) == 0:
+                continue
+            scores = coarse[i, self.assign[rows]] + tables[i].ravel()[self.codes[rows].astype(np.int64) + offsets].sum(axis=1)
+            candidates = rows[top_k(scores, k * self.refine)]
+            exact = self.vectors[candidates] @ query
+            top = top_k(exact, k)
+            similarities[i, :len(top)] = exact[top]
+            ids[i, :len(top)] = self.ids[candidates[top]]
+        return similarities, ids
+
+    def save(self, path):
+        """Write the index to the directory `path`, reopen with AnnIndex.load"""
+        os.makedirs(path, exist_ok=True)
+        arrays = {"vectors": self.vectors[:self.size], "ids": self.ids[:self.size]}
+        if self.trained:
+            arrays.update(codes=self.codes[:self.size], assign=self.assign[:self.size], centroids=self.centroids, codebooks=self.codebooks)
+        for name, array in arrays.items():
+            with open(os.path.join(path, name + ".npy.tmp"), "wb") as file:
+                np.save(file, array)
+            os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+        with open(os.path.join(path, "index.json"), "w") as file:
+            json.dump({"dim": self.dim, "nlist": self.nlist, "m": self.m, "nprobe": self.nprobe, "refine": self.refine,
+                       "exact_threshold": self.exact_threshold, "seed": self.seed, "size": self.size, "trained": self.trained,
+                       "trained_size": self.trained_size}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "index.json")) as file:
+            meta = json.load(file)
+        index = cls(meta["dim"], meta["nlist"], meta["m"], meta["nprobe"], meta["refine"], meta["exact_threshold"], meta["seed"])
+        # Vectors and codes are memory-mapped, adding to a loaded index copies them to memory
+        load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        index.size = meta["size"]
+        index.trained_size = meta["trained_size"]
+        index.vectors, index.ids = load("vectors"), np.array(load("ids"))
+        if meta["trained"]:
+            index.codes, index.assign = load("codes"), np.array(load("assign"))
+            index.centroids, index.codebooks = np.array(load("centroids")), np.array(load("codebooks"))
+            order = np.argsort(index.assign, kind="stable")
+            counts = np.bincount(index.assign, minlength=len(index.centroids))
+            index.lists = np.split(order, np.cumsum(counts)[:-1])
+        return index
+
+# ===============
+# HELPERS
+# ===============
+def recall_at_k(index, queries, k=10, nprobe=None):
+    """Share of the exact top `k` the index finds, averaged over the queries"""
+    exact = index.search_exact(queries, k)[1]
+    found = index.search(queries, k, nprobe)[1]
+    return float(np.mean([len(np.intersect1d(e[e >= 0], f[f >= 0])) / max(1, (e >= 0).sum()) for e, f in zip(exact, found)]))
+
+def nearest(candidates, queries, k=1, index=None, block=256):
+    """Most similar candidates of each query by cosine similarity, an exact scan unless an index is given.
+        Training an index costs far more than one scan, so an approximate search pays off only with an index
+        kept for the corpus and reused across queries, see open_index.
+
+    Args:
+        candidates (np.array): (n, dim) candidate vectors, e.g. sentence embeddings
+        queries (np.array): (q, dim) query vectors, or one vector
+        k (int, optional): Results per query. Defaults to 1.
+        index (AnnIndex, optional): Index of the candidates, searched instead of scanning them. Defaults to None.
+        block (int, optional): Queries scored at once. Defaults to 256.
+
+    Returns:
+        tuple: (cosine similarities, candidate positions), each (queries, k) best first, padded with -inf and -1
+    """
+    if index is not None:
+        return index.search(queries, k)
+    candidates = normalize(candidates)
+    queries = normalize(queries)
+    similarities = np.full((len(queries), k), -np.inf, np.float32)
+    ids = np.full((len(queries), k), -1, np.int64)
+    for start in range(0, len(queries), block):
+        scores = queries[start:start + block] @ candidates.T
+        for i, row in enumerate(scores, start):
+            top = top_k(row, k)
+            similarities[i, :len(top)] = row[top]
+            ids[i, :len(top)] = top
+    return similarities, ids
+
+def open_index(path, candidates=None):
+    """Index of a corpus saved in the directory `path`, built from `candidates` and saved the first time
+
+    Args:
+        path (str): Index directory
+        candidates (np.array, optional): (n, dim) vectors of the corpus, needed to build the index. Defaults to None.
+
+    Returns:
+        AnnIndex: The index, ids are the positions of the candidates
+    """
+    if os.path.exists(os.path.join(path, "index.json")):
+        return AnnIndex.load(path)
+    candidates = np.asarray(candidates)
+    index = AnnIndex(candidates.shape[1])
+    index.add(candidates)
+    index.save(path)
+    return index
+
+def clustered_vectors(count, dim=96, clusters=None, spread=0.3, seed=0):
+    """Synthetic embeddings: points around random cluster centres, 100 per cluster by default"""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters or max(1, count // 100), dim)).astype(np.float32)
+    return centres[rng.integers(0, len(centres), size=count)] + spread * rng.normal(size=(count, dim)).astype(np.float32)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k and speed of the IVF-PQ index against exact search")
+    parser.add_argument("--vectors", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=96)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    data = clustered_vectors(args.vectors + args.queries, args.dim)
+    queries, data = data[:args.queries], data[args.queries:]
+    index = AnnIndex(args.dim)
+    start_time = time.time()
+    for batch in np.array_split(data, 10):
+        index.add(batch)
+    print("Added {} vectors in {:.1f}s, {} lists, {} bytes per code".format(len(index), time.time() - start_time, len(index.centroids), index.m))
+
+    start_time = time.time()
+    index.search_exact(queries, args.k)
+    exact_time = time.time() - start_time
+    print("exact: {:.2f} ms/query".format(1000 * exact_time / args.queries))
+    for nprobe in (4, 8, 16, 32, 64):
+        start_time = time.time()
+        index.search(queries, args.k, nprobe)
+        search_time = time.time() - start_time
+        print("nprobe {:>2}: recall@{} {:.3f}, {:.2f} ms/query".format(nprobe, args.k, recall_at_k(index, queries, args.k, nprobe), 1000 * search_time / args.queries))
@@ -0,0 +1,141 @@
+import os, time, argparse
+
+import numpy as np
+
+# ===============
+# CONVERSION
+# ===============
+def store_paths(path):
+    """Matrix and vocabulary files of a store, next to the GloVe text file it is made from
+
+    Args:
+        path (str): GloVe text file, e.g. "data/glove.6B.300d.txt", or the store prefix "data/glove.6B.300d"
+
+    Returns:
+        tuple: (matrix .npy path, vocabulary path)
+    """
+    prefix = path[:-4] if path.endswith(".txt") else path
+    return prefix + ".npy", prefix + ".vocab"
+
+def convert_glove(txt_path, dtype=np.float32):
+    """One-time conversion of a GloVe text file to a contiguous .npy matrix and a vocabulary file, one word per line in row order.
+        Rows are written straight into a memory-mapped file, so memory stays flat whatever the size of the file.
+
+    Args:
+        txt_path (str): GloVe text file, "word v1 v2 ..." per line
+        dtype (type, optional): np.float32, or np.float16 for half the size. Defaults to np.float32.
+
+    Returns:
+        tuple: (matrix path, vocabulary path)
+    """
+    npy_path, vocab_path = store_paths(txt_path)
+    with open(txt_path, "rb") as file:
+        rows = sum(1 for _ in file)
+    with open(txt_path, encoding="utf-8") as file:
+        dim = len(file.readline().rstrip("\n").split(" ")) - 1
+
+    # Written under temporary names, a conversion cut short is not mistaken for a finished one
+    matrix = np.lib.format.open_memmap(npy_path + ".tmp", mode="w+", dtype=dtype, shape=(rows, dim))
+    words = []
+    with open(txt_path, encoding="utf-8") as file:
+        for i, line in enumerate(file):
+            word, vector = line.rstrip("\n").split(" ", maxsplit=1)
+            matrix[i] = np.fromstring(vector, dtype=np.float32, sep=" ")
+            words.append(word)
+    matrix.flush()
+    del matrix
+
+    with open(vocab_path + ".tmp", "w", encoding="utf-8") as file:
+        file.write("\n".join(words))
+    os.replace(npy_path + ".tmp", npy_path)
+    os.replace(vocab_path + ".tmp", vocab_path)
+    return npy_path, vocab_path
+
+# ===============
+# STORE
+# ===============
+class EmbeddingStore():
+    """Word vectors memory-mapped from a .npy matrix.
+        Opening only reads the vocabulary, rows are paged in from disk on first use
+        and the pages are shared by every process mapping the same file.
+        Lookups return read-only row views, nothing is copied.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Store prefix or the GloVe text file it was converted from
+        """
+        npy_path, vocab_path = store_paths(path)
+        self.vectors = np.load(npy_path, mmap_mode="r")
+        with open(vocab_path, encoding="utf-8") as file:
+            # Not splitlines(), a few GloVe words contain unicode line separators
+            self.words = file.read().split("\n")
+        self.index = {word: i for i, word in enumerate(self.words)}
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    @property
+    def dtype(self):
+        return self.vectors.dtype
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __getitem__(self, word):
+        return self.vectors[self.index[word]]
+
+    def get(self, word, default=None):
+        i = self.index.get(word)
+        return default if i is None else self.vectors[i]
+
+    def keys(self):
+        return self.index.keys()
+
+    def ids(self, words):
+        """Row of each word, in one pass over the vocabulary index
+
+        Args:
+            words (list): Words, e.g. the tokens of a document
+
+        Returns:
+            np.ndarray: int64 row of each word, -1 for words not in the vocabulary
+        """
+        index = self.index
+        return np.fromiter((index.get(word, -1) for word in words), np.int64, len(words))
+
+def load_embeddings(txt_path, dtype=np.float32):
+    """Open the store of a GloVe text file, converting it the first time
+
+    Args:
+        txt_path (str): GloVe text file, e.g. "data/glove.6B.300d.txt"
+        dtype (type, optional): Matrix type of a new conversion, np.float32 or np.float16. Defaults to np.float32.
+
+    Returns:
+        EmbeddingStore: The store
+    """
+    npy_path, vocab_path = store_paths(txt_path)
+    if not (os.path.exists(npy_path) and os.path.exists(vocab_path)):
+        start_time = time.time()
+        convert_glove(txt_path, dtype)
+        print("Converted {} in {:.1f}s".format(txt_path, time.time() - start_time))
+    return EmbeddingStore(txt_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert GloVe text vectors to a memory-mapped .npy store")
+    parser.add_argument("txt_path", help="GloVe text file, e.g. data/glove.6B.300d.txt")
+    parser.add_argument("--float16", action="store_true", help="store half-precision vectors, half the size")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    paths = convert_glove(args.txt_path, np.float16 if args.float16 else np.float32)
+    print("Wrote {} and {} in {:.1f}s".format(*paths, time.time() - start_time))
+
+    start_time = time.time()
+    store = EmbeddingStore(args.txt_path)
+    print("Opened {} words x {} ({}) in {:.3f}s".format(len(store), store.dim, store.dtype, time.time() - start_time))
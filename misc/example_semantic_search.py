@@ -28,20 +28,17 @@ def part_of_speech():
     # - Conjunctions: These are like glue words. They connect words or sentences together. For example, "and," "but," "because," and "or."
     # - Pronouns: These are like shortcuts for nouns. Instead of saying a name all the time, we use pronouns. For example, "he," "she," "it," and "they."
 
-    import spacy
-
-    # Let's call our magical friend
-    nlp = spacy.load("en_core_web_sm")
+    from nlp_service import pos_tags
 
     # Our story
     story = "The curious cat chased the playful dog through the green garden."
 
-    # Let's ask our magical friend to analyze the story
-    doc = nlp(story)
+    # Let's ask our magical friend to analyze the story, loaded once and running only the tagger
+    tagged = pos_tags([story])[0]
 
     # Now, let's see the roles of each word
-    for word in doc:
-        print(word.text, "-", word.pos_)
+    for text, pos in tagged:
+        print(text, "-", pos)
 
 def bag_of_words():
     # learn about the text by counting the words in its bag
@@ -67,11 +64,8 @@ def bag_of_words():
     print(word_counts.toarray())
 
 def sliding_window():
-    import spacy
     from sklearn.feature_extraction.text import CountVectorizer
-
-    # Let's call our magical friend for parts-of-speech
-    nlp = spacy.load("en_core_web_sm")
+    from nlp_service import tokens
 
     # Let's create our bag-of-words tool
     vectorizer = CountVectorizer()
@@ -85,11 +79,9 @@ def sliding_window():
     # Create a sliding window of size 3 words
     window_size = 3
 
-    # Let's process each sentence with our magical friend and sliding window
+    # Let's split every sentence into words in one batch and slide the window over them
     word_groups = []
-    for sentence in sentences:
-        doc = nlp(sentence)
-        words = [token.text for token in doc]
+    for words in tokens(sentences):
         for i in range(len(words) - window_size + 1):
             word_group = " ".join(words[i:i+window_size])
             word_groups.append(word_group)
@@ -103,13 +95,15 @@ def sliding_window():
     print(word_group_counts.toarray())
 
 # %%
-def find_sentence_from_excerpts():
-    import spacy
-    from sklearn.metrics.pairwise import cosine_similarity
-    import numpy as np
+def find_sentence_from_excerpts(index=None):
+    """Find the excerpt most similar to the input sentence
 
-    # Load the spaCy English model
-    nlp = spacy.load("en_core_web_sm")
+    Args:
+        index (AnnIndex, optional): Index of the excerpt embeddings kept for the corpus, see ann_index.open_index.
+            Defaults to None, an exact scan of the excerpts.
+    """
+    from nlp_service import vectors
+    from ann_index import nearest
 
     # Input sentence
     input_sentence = "It is a truth universally acknowledged, that a single man in possession of a good fortune, must be in want of a wife."
@@ -138,15 +132,14 @@ def find_sentence_from_excerpts():
         "20) every thing else she is as good natured a girl as ever lived. i will go directly to mr. bennet, and we shall very soon settle it with",
     ]
 
-    # Calculate sentence embeddings using spaCy
-    input_embedding = nlp(input_sentence).vector
-    data_embeddings = [nlp(sentence).vector for sentence in data_sentences]
+    # Calculate sentence embeddings using spaCy, in one batch through tok2vec only
+    input_embedding, *_ = vectors([input_sentence])
+    data_embeddings = vectors(data_sentences)
 
-    # Calculate cosine similarity scores
-    similarity_scores = cosine_similarity([input_embedding], data_embeddings)[0]
-
-    # Find the index of the most similar data sentence
-    most_similar_index = np.argmax(similarity_scores)
+    # Find the index of the most similar data sentence by cosine similarity,
+    # an exact scan, or a search of the persistent IVF-PQ index of a large corpus
+    similarity_scores, indexes = nearest(data_embeddings, input_embedding, k=1, index=index)
+    most_similar_index = indexes[0, 0]
 
     # Print the most similar data sentence
     print("Input Sentence:", input_sentence)
@@ -156,12 +149,13 @@ def find_sentence_from_excerpts():
 find_sentence_from_excerpts()
 
 # %%
-import spacy
 from sklearn.metrics.pairwise import cosine_similarity
 from scipy.cluster.hierarchy import linkage, fcluster
+from nlp_service import vectors
 
-def merge_overlapping_results(data_sentences, similarity_threshold=0.4):
-    """From a list of sentences, group them into clusters based on their similarity
+def merge_overlapping_results_hierarchical(data_sentences, similarity_threshold=0.4):
+    """From a list of sentences, group them into clusters based on their similarity.
+        The previous version, kept as the baseline of the benchmark below: O(n^2) memory and O(n^3) time.
 
     Args:
         data_sentences (list): List of sentences
@@ -171,11 +165,8 @@ def merge_overlapping_results(data_sentences, similarity_threshold=0.4):
         Dictionary: A dictionary of clusters and their sentences.
     """
 
-    # Load the spaCy English model
-    nlp = spacy.load("en_core_web_sm")
-
-    # Calculate sentence embeddings using spaCy
-    data_embeddings = [nlp(sentence).vector for sentence in data_sentences]
+    # Calculate sentence embeddings using spaCy, the model is loaded once per process
+    data_embeddings = vectors(data_sentences)
 
     # Calculate cosine similarity matrix
     similarity_matrix = cosine_similarity(data_embeddings)
@@ -198,6 +189,9 @@ def merge_overlapping_results(data_sentences, similarity_threshold=0.4):
 
     return list(merged_results.values())
 
+# Shingle MinHash/LSH and union-find, near-linear in the number of sentences
+from near_duplicates import merge_overlapping_results, windowed_excerpts
+
 # Example data sentences
 data_sentences = [
     "1) as he chooses. nobody wants him to come. though i shall always say that he used my daughter extremely ill ; and if i was her, i",
@@ -232,3 +226,40 @@ for idx, cluster in enumerate(merged_results, start=1):
     print("="*50)
 
 # %%
+import time
+from itertools import combinations
+
+# The larger benchmarks take minutes (the baseline on 2000 sentences, then 100k sentences), run them on demand
+RUN_BENCHMARK = False
+
+def same_cluster_pairs(clusters):
+    return {frozenset(pair) for cluster in clusters for pair in combinations(cluster, 2) if pair[0] != pair[1]}
+
+def benchmark_merge(sentences, baseline=True):
+    """Time merge_overlapping_results and compare its clusters with the hierarchical baseline
+
+    Args:
+        sentences (list): List of sentences
+        baseline (bool, optional): Also run the baseline, slow past a few thousand sentences. Defaults to True.
+    """
+    start_time = time.time()
+    clusters = merge_overlapping_results(sentences)
+    print(f"{len(sentences)} sentences, MinHash/LSH: {len(clusters)} clusters in {time.time() - start_time:.2f}s")
+    if not baseline:
+        return
+
+    start_time = time.time()
+    baseline_clusters = merge_overlapping_results_hierarchical(sentences)
+    print(f"{len(sentences)} sentences, hierarchical: {len(baseline_clusters)} clusters in {time.time() - start_time:.2f}s")
+
+    # Pairs of sentences put in the same cluster by both, by the baseline only and by the new function only
+    pairs, baseline_pairs = same_cluster_pairs(clusters), same_cluster_pairs(baseline_clusters)
+    print(f"Pairs in both: {len(pairs & baseline_pairs)}, baseline only: {len(baseline_pairs - pairs)}, new only: {len(pairs - baseline_pairs)}")
+
+benchmark_merge(data_sentences)
+if RUN_BENCHMARK:
+    benchmark_merge(windowed_excerpts(2000))
+    for count in (10000, 100000):
+        benchmark_merge(windowed_excerpts(count), baseline=False)
+
+# %%
@@ -0,0 +1,226 @@
+import time, zlib, argparse
+
+import numpy as np
+
+# Fixed seeds, the same texts always get the same signatures
+_rng = np.random.default_rng(20230901)
+SHINGLE_MULTIPLIERS = _rng.integers(1, 2**63, size=16, dtype=np.uint64) | np.uint64(1)
+BAND_MULTIPLIERS = _rng.integers(1, 2**63, size=64, dtype=np.uint64) | np.uint64(1)
+
+# ===============
+# UNION-FIND
+# ===============
+class UnionFind():
+    """Union-find over arrays of pairs. A union round hooks the larger root of each pair to the smaller one
+        and compresses the paths fully, so the parent of every item is always its root.
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n)
+
+    def connected(self, a, b):
+        return self.parent[a] == self.parent[b]
+
+    def union(self, a, b):
+        """Join the items of each pair
+
+        Args:
+            a (np.array): First item of each pair
+            b (np.array): Second item of each pair
+        """
+        parent = self.parent
+        while len(a):
+            root_a, root_b = parent[a], parent[b]
+            joined = root_a != root_b
+            if not joined.any():
+                break
+            a, b = a[joined], b[joined]
+            np.minimum.at(parent, np.maximum(root_a, root_b)[joined], np.minimum(root_a, root_b)[joined])
+            while True:
+                grandparent = parent[parent]
+                if np.array_equal(grandparent, parent):
+                    break
+                parent = grandparent
+        self.parent = parent
+
+    def labels(self):
+        """Cluster of each item, numbered in order of first appearance"""
+        # Roots are the smallest item of their cluster, so ranking them keeps the order of first appearance
+        return np.unique(self.parent, return_inverse=True)[1].reshape(-1)
+
+def _bucket_pairs(keys):
+    """Pairs of items with the same key: each item with the previous one and with the first one of its bucket"""
+    if len(keys) < 2:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    same = keys[1:] == keys[:-1]
+    starts = np.flatnonzero(np.r_[True, ~same])
+    heads = order[starts[np.cumsum(np.r_[True, ~same]) - 1]]
+    previous = order[:-1][same], order[1:][same]
+    members = order != heads
+    return np.r_[previous[0], heads[members]], np.r_[previous[1], order[members]]
+
+# ===============
+# MINHASH
+# ===============
+def shingle_hashes(text, shingle_size, cache):
+    """Hashes of the word shingles of a text, texts shorter than `shingle_size` words are one shingle"""
+    words = text.lower().split()
+    hashes = []
+    for word in words:
+        h = cache.get(word)
+        if h is None:
+            h = cache[word] = zlib.crc32(word.encode("utf-8")) + 1
+        hashes.append(h)
+    hashes = np.array(hashes, np.uint64)
+    width = min(shingle_size, len(hashes))
+    if width == 0:
+        return np.zeros(1, np.uint64)
+    shingles = np.zeros(len(hashes) - width + 1, np.uint64)
+    for j in range(width):
+        shingles += hashes[j:len(hashes) - width + 1 + j] * SHINGLE_MULTIPLIERS[j]
+    return shingles
+
+def minhash_signatures(texts, shingle_size=3, num_perm=96, chunk_size=2000, seed=1):
+    """MinHash signature of each text over its word shingles, computed `chunk_size` texts at a time
+
+    Args:
+        texts (list): Texts, e.g. windowed excerpts
+        shingle_size (int, optional): Words per shingle. Defaults to 3.
+        num_perm (int, optional): Hash functions, the length of each signature. Defaults to 96.
+        chunk_size (int, optional): Texts hashed at once, bounds memory. Defaults to 2000.
+        seed (int, optional): Seed of the hash functions. Defaults to 1.
+
+    Returns:
+        np.ndarray: (len(texts), num_perm) uint32 signatures
+    """
+    rng = np.random.default_rng(seed)
+    # Multiply-shift hashes of the 64-bit shingle hashes, the top 32 bits are kept
+    multipliers = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    offsets = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), np.uint32)
+    cache = {}
+    for start in range(0, len(texts), chunk_size):
+        shingles = [shingle_hashes(text, shingle_size, cache) for text in texts[start:start + chunk_size]]
+        starts = np.r_[0, np.cumsum([len(s) for s in shingles])[:-1]]
+        hashes = np.concatenate(shingles)
+        hashes ^= hashes >> np.uint64(31)
+        # One row per hash function, so the minimum of each text runs over contiguous memory
+        values = (multipliers[:, None] * hashes + offsets[:, None]) >> np.uint64(32)
+        signatures[start:start + len(shingles)] = np.minimum.reduceat(values, starts, axis=1).T
+    return signatures
+
+def lsh_union(signatures, union_find, bands=32, threshold=0.5, block=65536):
+    """Join texts sharing a band of their signatures when their estimated Jaccard similarity reaches `threshold`
+
+    Args:
+        signatures (np.array): MinHash signatures
+        union_find (UnionFind): Clusters to join the pairs in
+        bands (int, optional): Bands of the signatures, more bands find less similar pairs. Defaults to 32.
+        threshold (float, optional): Minimum share of equal hash values. Defaults to 0.5.
+        block (int, optional): Pairs checked at once. Defaults to 65536.
+    """
+    rows = signatures.shape[1] // bands
+    for band in range(bands):
+        columns = signatures[:, band * rows:(band + 1) * rows].astype(np.uint64)
+        a, b = _bucket_pairs((columns * BAND_MULTIPLIERS[:rows]).sum(axis=1))
+        # Pairs already in one cluster are not checked again, most are after the first bands
+        todo = ~union_find.connected(a, b)
+        a, b = a[todo], b[todo]
+        # Buckets can hold unrelated texts whose keys collided, each pair is checked on the full signature,
+        # a block of pairs at a time so the compared rows stay small
+        keep = np.concatenate([(signatures[a[i:i + block]] == signatures[b[i:i + block]]).mean(axis=1) >= threshold
+                               for i in range(0, len(a), block)] or [np.zeros(0, bool)])
+        union_find.union(a[keep], b[keep])
+
+def embedding_union(embeddings, union_find, threshold=0.9, bands=8, bits=12, seed=1, block=16384):
+    """Join embeddings with a cosine similarity of at least `threshold`, found in random hyperplane buckets
+
+    Args:
+        embeddings (np.array): One row per text, e.g. sentence vectors
+        union_find (UnionFind): Clusters to join the pairs in
+        threshold (float, optional): Minimum cosine similarity. Defaults to 0.9.
+        bands (int, optional): Independent bucketings. Defaults to 8.
+        bits (int, optional): Hyperplanes per bucketing, fewer bits find less similar pairs. Defaults to 12.
+        seed (int, optional): Seed of the hyperplanes. Defaults to 1.
+        block (int, optional): Pairs checked at once. Defaults to 16384.
+    """
+    embeddings = np.asarray(embeddings, np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = embeddings / np.where(norms == 0, 1, norms)
+    weights = 1 << np.arange(bits, dtype=np.int64)
+    for band in range(bands):
+        planes = np.random.default_rng(seed + band).normal(size=(embeddings.shape[1], bits)).astype(np.float32)
+        a, b = _bucket_pairs(((unit @ planes) > 0) @ weights)
+        todo = ~union_find.connected(a, b)
+        a, b = a[todo], b[todo]
+        keep = np.concatenate([np.einsum("ij,ij->i", unit[a[i:i + block]], unit[b[i:i + block]]) >= threshold
+                               for i in range(0, len(a), block)] or [np.zeros(0, bool)])
+        union_find.union(a[keep], b[keep])
+
+# ===============
+# CLUSTERING
+# ===============
+def cluster_excerpts(texts, embeddings=None, shingle_size=3, jaccard_threshold=0.5, cosine_threshold=0.9, num_perm=96, bands=32):
+    """Group near-duplicate excerpts, e.g. overlapping windows of the same passage.
+        Texts sharing enough word shingles (MinHash/LSH) are joined, and with `embeddings` also texts of similar meaning;
+        groups are the connected components of these pairs, joined in a union-find. Time and memory grow linearly with the number of excerpts.
+
+    Args:
+        texts (list): Excerpts
+        embeddings (np.array, optional): Vector of each excerpt, to also join excerpts by cosine similarity. Defaults to None.
+        shingle_size (int, optional): Words per shingle. Defaults to 3.
+        jaccard_threshold (float, optional): Minimum estimated shingle Jaccard similarity. Defaults to 0.5.
+        cosine_threshold (float, optional): Minimum cosine similarity of the embeddings. Defaults to 0.9.
+        num_perm (int, optional): Length of the MinHash signatures. Defaults to 96.
+        bands (int, optional): LSH bands, `num_perm` must be a multiple. Defaults to 32.
+
+    Returns:
+        np.ndarray: Cluster of each excerpt, numbered in order of first appearance
+    """
+    if len(texts) == 0:
+        return np.zeros(0, np.int64)
+    union_find = UnionFind(len(texts))
+    lsh_union(minhash_signatures(texts, shingle_size, num_perm), union_find, bands, jaccard_threshold)
+    if embeddings is not None:
+        embedding_union(embeddings, union_find, cosine_threshold)
+    return union_find.labels()
+
+def merge_overlapping_results(data_sentences, jaccard_threshold=0.5, embeddings=None):
+    """From a list of sentences, group the ones that overlap or are near copies of each other
+
+    Args:
+        data_sentences (list): List of sentences
+        jaccard_threshold (float, optional): Minimum share of word shingles in common, higher the stricter.
+            Unlike the distance threshold of the hierarchical version (lower the stricter), roughly 1 - that threshold. Defaults to 0.5.
+        embeddings (np.array, optional): Vector of each sentence, to also group sentences of similar meaning. Defaults to None.
+
+    Returns:
+        list: The sentences of each cluster, in order of first appearance
+    """
+    labels = cluster_excerpts(data_sentences, embeddings, jaccard_threshold=jaccard_threshold)
+    clusters = [[] for _ in range(labels.max() + 1 if len(labels) else 0)]
+    for sentence, label in zip(data_sentences, labels):
+        clusters[label].append(sentence)
+    return clusters
+
+def windowed_excerpts(count, width=28, vocabulary=5000, passages=None, seed=0):
+    """Synthetic search output: windows of `width` words at random offsets around a few passages of a random book"""
+    rng = np.random.default_rng(seed)
+    words = np.array(["w{}".format(i) for i in range(vocabulary)])
+    book = words[rng.integers(0, vocabulary, size=max(count * 4, 10000))]
+    passages = rng.integers(0, len(book) - 2 * width, size=passages or max(1, count // 20))
+    offsets = passages[rng.integers(0, len(passages), size=count)] + rng.integers(0, width // 2, size=count)
+    return [" ".join(book[offset:offset + width]) for offset in offsets]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time near-duplicate clustering of windowed excerpts")
+    parser.add_argument("--excerpts", type=int, nargs="*", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    for count in args.excerpts:
+        texts = windowed_excerpts(count)
+        start_time = time.time()
+        labels = cluster_excerpts(texts)
+        print("{} excerpts: {} clusters in {:.2f}s".format(count, labels.max() + 1, time.time() - start_time))
@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+import spacy
+
+MODEL = "en_core_web_sm"
+BATCH_SIZE = 256
+
+# Pipeline components each kind of output needs, the others are disabled.
+# In en_core_web_sm the vectors come from the tok2vec tensor and the coarse POS from the attribute_ruler mapping of the tags.
+COMPONENTS = {
+    "tokens": [],
+    "vectors": ["tok2vec"],
+    "pos": ["tok2vec", "tagger", "attribute_ruler"],
+}
+
+_nlps = {}
+_nlps_lock = threading.Lock()
+
+def get_nlp(model=MODEL, enable=None):
+    """spaCy pipeline loaded once per process for each model and set of components
+
+    Args:
+        model (str, optional): spaCy model. Defaults to MODEL.
+        enable (list, optional): Components to run, e.g. COMPONENTS["pos"], the others are disabled. Defaults to all of them.
+
+    Returns:
+        spacy.Language: The pipeline
+    """
+    key = (model, None if enable is None else tuple(sorted(enable)))
+    with _nlps_lock:
+        if key not in _nlps:
+            _nlps[key] = spacy.load(model) if enable is None else spacy.load(model, enable=list(enable))
+        return _nlps[key]
+
+def pipe(texts, components, model=MODEL, batch_size=BATCH_SIZE, n_process=1):
+    """Stream texts through the pipeline in batches
+
+    Args:
+        texts (iterable): Texts
+        components (str): Key of COMPONENTS, what the docs are needed for
+        model (str, optional): spaCy model. Defaults to MODEL.
+        batch_size (int, optional): Texts per batch. Defaults to BATCH_SIZE.
+        n_process (int, optional): Processes, more than 1 for large inputs only as each loads the model. Defaults to 1.
+
+    Yields:
+        spacy.tokens.Doc: The doc of each text
+    """
+    nlp = get_nlp(model, COMPONENTS[components])
+    if not COMPONENTS[components]:
+        # Tokens only, the tokenizer streams without the pipeline
+        yield from nlp.tokenizer.pipe(texts, batch_size=batch_size)
+        return
+    yield from nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+
+def vectors(texts, model=MODEL, batch_size=BATCH_SIZE, n_process=1):
+    """Vector of each text, as `nlp(text).vector`
+
+    Args:
+        texts (list): Texts
+        model (str, optional): spaCy model. Defaults to MODEL.
+        batch_size (int, optional): Texts per batch. Defaults to BATCH_SIZE.
+        n_process (int, optional): Processes. Defaults to 1.
+
+    Returns:
+        np.ndarray: (len(texts), dim) float32 matrix, one row per text
+    """
+    texts = list(texts)
+    matrix = None
+    for i, doc in enumerate(pipe(texts, "vectors", model, batch_size, n_process)):
+        if matrix is None:
+            matrix = np.empty((len(texts), len(doc.vector)), np.float32)
+        matrix[i] = doc.vector
+    return matrix if matrix is not None else np.zeros((0, 0), np.float32)
+
+def pos_tags(texts, model=MODEL, batch_size=BATCH_SIZE, n_process=1):
+    """(word, coarse part-of-speech) of each token of each text"""
+    return [[(token.text, token.pos_) for token in doc] for doc in pipe(texts, "pos", model, batch_size, n_process)]
+
+def tokens(texts, model=MODEL, batch_size=BATCH_SIZE):
+    """Words of each text, from the tokenizer alone"""
+    return [[token.text for token in doc] for doc in pipe(texts, "tokens", model, batch_size)]
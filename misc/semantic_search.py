@@ -0,0 +1,369 @@
+import os, json
+
+import nltk
+import numpy as np
+
+# Parts-of-speech kept in the embeddings, the other words (stop words) are masked out
+ALLOWED_POS = ['NN','NNS','NNP','NNPS','JJ','RB','VB','VBG','VBN','VBP','VBZ','VBD']
+
+# ===============
+# EMBEDDING
+# ===============
+def clean_text(content):
+    return content.replace('\n', ' ').replace('_', "").lower()
+
+def tokenize(content):
+    return nltk.word_tokenize(clean_text(content))
+
+def _embed(ids, keep, embedding_dict):
+    # Masked and unknown words stay null vectors, the others are gathered with one fancy index
+    keep = keep & (ids >= 0)
+    embedding = np.zeros((len(ids), embedding_dict.dim), np.float32)
+    embedding[keep] = embedding_dict.vectors[ids[keep]]
+    return embedding
+
+def sequence_embedding(content, embedding_dict, allowed_pos=ALLOWED_POS, tokens=None):
+    """Takes text content as a string and returns a matrix with the embeddings for each word according to a given store.
+        Use a list of allowed parts-of-speech, to give more control over what categories of words will be kept or masked out.
+        This list, also known as list of ___stop words___ - frequently occurrying words that can be removed from the bag-of-words representation without much loss of meaning.
+
+    Args:
+        content (str): String to be embedded
+        embedding_dict (EmbeddingStore): Embedding store, see embedding_store.py
+        allowed_pos (list, optional): List of allowed parts-of-speech. Defaults to ALLOWED_POS.
+        tokens (list, optional): Tokens of `content` if already tokenized. Defaults to None.
+
+    Returns:
+        np.array: The embedded `content`, one float32 row per token
+    """
+    tokens = tokenize(content) if tokens is None else tokens
+    allowed_pos = set(allowed_pos)
+    keep = np.fromiter((tag in allowed_pos for _, tag in nltk.pos_tag(tokens)), bool, len(tokens))
+    return _embed(embedding_dict.ids(tokens), keep, embedding_dict)
+
+def sequence_embeddings(contents, embedding_dict, allowed_pos=ALLOWED_POS):
+    """sequence_embedding of many documents, tagged as one batch and gathered from the store at once
+
+    Args:
+        contents (list): Strings to be embedded
+        embedding_dict (EmbeddingStore): Embedding store
+        allowed_pos (list, optional): List of allowed parts-of-speech. Defaults to ALLOWED_POS.
+
+    Returns:
+        list: The embedding of each document, views into one matrix
+    """
+    if not contents:
+        return []
+    token_lists = [tokenize(content) for content in contents]
+    tokens = [token for token_list in token_lists for token in token_list]
+    allowed_pos = set(allowed_pos)
+    keep = np.fromiter((tag in allowed_pos for tagged in nltk.pos_tag_sents(token_lists) for _, tag in tagged), bool, len(tokens))
+    embedding = _embed(embedding_dict.ids(tokens), keep, embedding_dict)
+    return np.split(embedding, np.cumsum([len(token_list) for token_list in token_lists])[:-1])
+
+# ===============
+# SLIDING WINDOW SEARCH
+# ===============
+def cosine_distance(vec1, vec2):
+    """Calculate the _cosine distance_ between embeddings.
+        Standalone function from the one in `scipy` package
+
+    Args:
+        vec1 (np.array): Embedding 1
+        vec2 (np.array): Embedding 2
+
+    Returns:
+        int: Distance between Embedding 1 and 2
+    """
+
+    dot_prod = np.dot(vec1, vec2)
+    norm1 = np.sqrt(np.sum(vec1 ** 2))
+    norm2 = np.sqrt(np.sum(vec2 ** 2))
+
+    if norm1 == 0 or norm2 == 0:
+        return 1
+    else:
+        return 1 - dot_prod / (norm1 * norm2)
+
+def prefix_sums(embedding, dtype=np.float64):
+    """Cumulative sums of the rows with a leading zero row, the sum of rows [i, j) is prefix[j] - prefix[i]"""
+    prefix = np.zeros((len(embedding) + 1, embedding.shape[1]), dtype)
+    np.cumsum(embedding, axis=0, out=prefix[1:])
+    return prefix
+
+def window_norms(embedding, width, block=4096, prefix=None):
+    """Norm of the sum of every window of `width` rows, from prefix sums taken one block of windows at a time
+
+    Args:
+        embedding (np.array): The embedded book
+        width (int): Window length in tokens
+        block (int, optional): Windows per block, bounds the float64 sums held at once. Defaults to 4096.
+        prefix (np.array, optional): prefix_sums of the whole book if already computed. Defaults to None.
+
+    Returns:
+        np.ndarray: Norm of each window, by start position
+    """
+    count = max(0, len(embedding) - width + 1)
+    norms = np.empty(count)
+    for start in range(0, count, block):
+        stop = min(count, start + block)
+        if prefix is None:
+            local = prefix_sums(embedding[start:stop + width - 1])
+            sums = local[width:] - local[:stop - start]
+        else:
+            sums = prefix[start + width:stop + width] - prefix[start:stop]
+        norms[start:stop] = np.sqrt(np.einsum("ij,ij->i", sums, sums))
+    return norms
+
+def top_k(distances, count):
+    """Positions of the `count` smallest distances, closest first, without sorting the whole array"""
+    count = min(count, len(distances))
+    if count == 0:
+        return np.zeros(0, np.int64)
+    top = np.argpartition(distances, count - 1)[:count]
+    return top[np.argsort(distances[top], kind="stable")]
+
+class SlidingSearch():
+    """Cosine distance between excerpts and every window of a book, for several window lengths at once.
+        The dot products of all windows come from one matrix product with the excerpts and a cumulative sum,
+        the window norms do not depend on the excerpts and are kept per window length.
+    """
+
+    def __init__(self, embedding, prefix=None):
+        """
+        Args:
+            embedding (np.array): The embedded book, see sequence_embedding
+            prefix (np.array, optional): prefix_sums of the book, to compute the norms of new window lengths faster. Defaults to None.
+        """
+        self.embedding = embedding
+        self.prefix = prefix
+        self.norms = {} # window length -> norm of each window
+
+    def window_norms(self, width):
+        if width not in self.norms:
+            self.norms[width] = window_norms(self.embedding, width, prefix=self.prefix)
+        return self.norms[width]
+
+    def _distances(self, queries, widths):
+        query_norms = np.sqrt(np.einsum("ij,ij->i", queries, queries))
+        prefix = np.zeros((len(self.embedding) + 1, len(queries)))
+        np.cumsum(self.embedding @ queries.T.astype(self.embedding.dtype), axis=0, out=prefix[1:])
+
+        results = []
+        for i, query_widths in enumerate(widths):
+            distances = {}
+            for width in query_widths:
+                if width <= 0:
+                    raise ValueError("Window length must be positive, got {}".format(width))
+                norms = self.window_norms(width)
+                dots = prefix[width:, i] - prefix[:len(norms), i]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    distance = 1 - dots / (norms * query_norms[i])
+                # Windows or excerpts of only null vectors are as far as can be
+                distance[(norms == 0) | (query_norms[i] == 0)] = 1
+                distances[width] = distance
+            results.append(distances)
+        return results
+
+    def distances(self, excerpt, widths):
+        """
+        Args:
+            excerpt (np.array): The embedded excerpt
+            widths (list): Window lengths in tokens
+
+        Returns:
+            dict: Distance of each window by start position, by window length
+        """
+        # The bag-of-words excerpt embedding, a sum rather than a mean as the cosine ignores the scale
+        return self._distances(excerpt.sum(axis=0, dtype=np.float64)[None], [widths])[0]
+
+    def search_many(self, excerpts, margins=(0,), count=1, batch=64):
+        """Best windows of many excerpts, scored `batch` excerpts per matrix product
+
+        Args:
+            excerpts (list): The embedded excerpts
+            margins (list, optional): Tokens added to the excerpt length, one window length each. Defaults to (0,).
+            count (int, optional): Number of matches per excerpt. Defaults to 1.
+            batch (int, optional): Excerpts per matrix product. Defaults to 64.
+
+        Returns:
+            list: Matches of each excerpt, (start position, margin, distance) closest first
+        """
+        results = []
+        for start in range(0, len(excerpts), batch):
+            chunk = excerpts[start:start + batch]
+            queries = np.array([excerpt.sum(axis=0, dtype=np.float64) for excerpt in chunk])
+            all_distances = self._distances(queries, [[len(excerpt) + margin for margin in margins] for excerpt in chunk])
+            for excerpt, distances in zip(chunk, all_distances):
+                matches = []
+                for margin in margins:
+                    distance = distances[len(excerpt) + margin]
+                    matches += [(int(position), margin, float(distance[position])) for position in top_k(distance, count)]
+                results.append(sorted(matches, key=lambda match: match[2])[:count])
+        return results
+
+    def search(self, excerpt, margins=(0,), count=1):
+        """Best windows over every margin
+
+        Args:
+            excerpt (np.array): The embedded excerpt
+            margins (list, optional): Tokens added to the excerpt length, one window length each. Defaults to (0,).
+            count (int, optional): Number of matches. Defaults to 1.
+
+        Returns:
+            list: (start position, margin, distance) of each match, closest first
+        """
+        return self.search_many([excerpt], margins, count)[0]
+
+def sliding_distance(book, excerpt, margin = 0):
+    """Calculates the cosine distance between 
+        - the input exerpt (embedded exerpt)
+        - each possible sentence in the book (the embeddings of a sliding window of words throughout the entire book)
+
+    Args:
+        book (np.array): The embedded book
+        excerpt (np.array): The embedded input excerpt
+        margin (int, optional): To search for sentences that are longer than the provided excerpt. Defaults to 0.
+
+    Returns:
+        ndarray: Distance of each window, by start position
+    """
+    width = excerpt.shape[0] + margin
+    return SlidingSearch(book).distances(excerpt, [width])[width]
+
+# ===============
+# BOOK INDEX
+# ===============
+def token_spans(text, tokens):
+    """Character span in `text` of each token of clean_text(text)
+
+    Args:
+        text (str): The document in raw text
+        tokens (list): Tokens of the cleaned text, as returned by tokenize
+
+    Returns:
+        np.ndarray: (start, end) of each token in `text`, int64
+    """
+    # Position in `text` of each character of the cleaned text
+    origin = [i for i, c in enumerate(text) for _ in clean_text(c)]
+    clean = clean_text(text)
+    spans = np.zeros((len(tokens), 2), np.int64)
+    position = 0
+    for i, token in enumerate(tokens):
+        # nltk writes quotes as `` and ''
+        found = [(clean.find(t, position), t) for t in ((token, '"') if token in ("``", "''") else (token,))]
+        found = [(start, t) for start, t in found if start >= 0]
+        if found:
+            start, t = min(found)
+            position = start + len(t)
+        else:
+            start = position
+        spans[i] = (origin[start] if start < len(origin) else len(text), origin[position - 1] + 1 if position else 0)
+    return spans
+
+class BookIndex():
+    """A book embedded once for many excerpt searches.
+        Holds the token spans in the raw text, the masked embedding matrix, its prefix sums
+        and the window norms computed so far, and is saved to a directory whose matrices are memory-mapped on load.
+        A query then costs the embedding of the excerpt and one matrix-vector product.
+    """
+
+    def __init__(self, text, spans, embedding, prefix, norms=None):
+        """Use BookIndex.build or BookIndex.load
+
+        Args:
+            text (str): The document in raw text
+            spans (np.array): (start, end) of each token in `text`
+            embedding (np.array): Masked embedding of each token
+            prefix (np.array): prefix_sums of the embedding
+            norms (dict, optional): Window norms by window length. Defaults to None.
+        """
+        self.text = text
+        self.spans = spans
+        self.embedding = embedding
+        self.prefix = prefix
+        self.search = SlidingSearch(embedding, prefix)
+        self.search.norms.update(norms or {})
+
+    @classmethod
+    def build(cls, text, embedding_dict, allowed_pos=ALLOWED_POS):
+        """
+        Args:
+            text (str): The document in raw text
+            embedding_dict (EmbeddingStore): Embedding store
+            allowed_pos (list, optional): List of allowed parts-of-speech. Defaults to ALLOWED_POS.
+
+        Returns:
+            BookIndex: The index
+        """
+        tokens = tokenize(text)
+        embedding = sequence_embedding(text, embedding_dict, allowed_pos, tokens=tokens)
+        return cls(text, token_spans(text, tokens), embedding, prefix_sums(embedding))
+
+    def __len__(self):
+        return len(self.spans)
+
+    def save(self, path):
+        """Write the index to the directory `path`, reopen with BookIndex.load"""
+        os.makedirs(path, exist_ok=True)
+        widths = sorted(self.search.norms)
+        arrays = {name: getattr(self, name) for name in ("spans", "embedding", "prefix")}
+        arrays["norms"] = np.concatenate([self.search.norms[width] for width in widths]) if widths else np.zeros(0)
+        # Files are replaced rather than overwritten, an index loaded from `path` keeps its mapping of the old ones
+        for name, array in arrays.items():
+            with open(os.path.join(path, name + ".npy.tmp"), "wb") as file:
+                np.save(file, array)
+            os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+        with open(os.path.join(path, "book.txt"), "w", encoding="utf-8") as file:
+            file.write(self.text)
+        with open(os.path.join(path, "index.json"), "w") as file:
+            json.dump({"tokens": len(self), "dim": self.embedding.shape[1], "widths": widths}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "index.json")) as file:
+            meta = json.load(file)
+        with open(os.path.join(path, "book.txt"), encoding="utf-8") as file:
+            text = file.read()
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in ("spans", "embedding", "prefix", "norms")}
+        # The norms of each saved width, one after the other
+        norms, offset = {}, 0
+        for width in meta["widths"]:
+            count = max(0, meta["tokens"] - width + 1)
+            norms[width] = arrays["norms"][offset:offset + count]
+            offset += count
+        return cls(text, arrays["spans"], arrays["embedding"], arrays["prefix"], norms)
+
+    def find_match(self, match_position, match_length):
+        """The raw text of `match_length` tokens starting at token `match_position`
+
+        Returns:
+            str: "[position] text" with the whitespace of the text collapsed
+        """
+        last = min(len(self), match_position + match_length) - 1
+        match = self.text[self.spans[match_position, 0]:self.spans[last, 1]]
+        return "[" + str(match_position) + "] " + " ".join(match.split())
+
+    def locate(self, excerpts, embedding_dict, margins=(0,), count=1, allowed_pos=ALLOWED_POS):
+        """Search the book for many excerpts, scored together in a few matrix products
+
+        Args:
+            excerpts (list): Excerpts in raw text
+            embedding_dict (EmbeddingStore): Embedding store the index was built with
+            margins (list, optional): Tokens added to the excerpt length, one window length each. Defaults to (0,).
+            count (int, optional): Number of matches per excerpt. Defaults to 1.
+            allowed_pos (list, optional): List of allowed parts-of-speech. Defaults to ALLOWED_POS.
+
+        Returns:
+            list: Matching excerpts of the book for each excerpt, closest first,
+                None for an excerpt with no word to search (empty, or only stopwords and unknown words)
+        """
+        embeddings = sequence_embeddings(excerpts, embedding_dict, allowed_pos)
+        # An excerpt without tokens has no window length, and one of only null vectors matches anywhere,
+        # both are skipped instead of failing the batch or returning an arbitrary match
+        searchable = [i for i, embedding in enumerate(embeddings) if embedding.any()]
+        matches = self.search.search_many([embeddings[i] for i in searchable], margins, count)
+        results = [None] * len(excerpts)
+        for i, excerpt_matches in zip(searchable, matches):
+            results[i] = [self.find_match(position, len(embeddings[i]) + 2 * margin) for position, margin, _ in excerpt_matches]
+        return results
@@ -1,9 +1,10 @@
-import openai,os
+import openai,os,json
 from dotenv import load_dotenv
 
 # Local imports
 from includes import helper_openai
-from includes.tool_search import search_google
+from includes.tool_search import search_parallel
+from includes.pipeline import Pipeline, Stage
 
 load_dotenv()
 
@@ -29,6 +30,35 @@ def generate_answer(prompt):
     print(helper_openai.print_job_detail(response))
     return response.choices[0].text.strip()
 
+def search(search_query):
+    # The engines are queried in parallel and the first answer wins
+    return search_parallel(search_query.replace('"',''))
+
+def answer_question(original_question, search_result):
+    # Generate an answer using the search result as a prompt
+    answer_prompt = f"Given the search result: {search_result}, answer the original question: {original_question}"
+    return generate_answer(answer_prompt)
+
+# query -> search -> answer, each stage with its own concurrency limit and cache
+PIPELINE = Pipeline([
+    Stage("search_query", generate_search_query, ["question"], concurrency=8),
+    Stage("search_result", search, ["search_query"], concurrency=16),
+    Stage("answer", answer_question, ["question", "search_result"], concurrency=8),
+])
+
+def answer_questions(questions):
+    """Run the websearch chain for many questions, the stages of different questions overlap
+
+    Args:
+        questions (list): Questions to answer
+
+    Returns:
+        list: For each question, a dict of the question and the result of every stage
+    """
+    results = PIPELINE.run_sync([{"question": question} for question in questions])
+    print("Stage latency:", json.dumps(PIPELINE.report(), indent=1))
+    return results
+
 # Main function
 def main():
     original_question = "What is the high temperature for Tokyo yesterday in Celsius"
@@ -41,15 +71,18 @@ def main():
     print("="*50)
     
     # Use the search query to fetch results
-    search_result = search_google(search_query.replace('"',''), os.getenv("SERPAPI_API_KEY"))
+    search_result = search(search_query)
     print("Search Result:", search_result)
     print("="*50)
     
-    # Generate an answer using the search result as a prompt
-    answer_prompt = f"Given the search result: {search_result}, answer the original question: {original_question}"
-    answer = generate_answer(answer_prompt)
+    answer = answer_question(original_question, search_result)
     
     print("Answer:", answer)
 
 if __name__ == "__main__":
     main()
+
+    # A batch of questions through the concurrent pipeline
+    # for result in answer_questions(["What is the high temperature for Tokyo yesterday in Celsius", "Who won the last world cup"]):
+    #     print(result["question"], "->", result["answer"] or result.get("error"))
+